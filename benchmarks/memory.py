@@ -0,0 +1,145 @@
+import argparse
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+
+# Measures the resident memory the bot's gateway cache needs for a given number of guilds,
+# with and without LEAN_CLIENT. Each profile runs in its own process, which imports the bot
+# and feeds synthetic GUILD_CREATE and MESSAGE_CREATE payloads straight into the client's
+# connection state, the same path real gateway events take. No bot token is needed.
+#
+#   python benchmarks/memory.py --guilds 2500 --messages 20000
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SELF_ID = 1173820242305224764
+
+def rss_kib():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+def user_payload(user_id):
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "global_name": None,
+            "avatar": None, "bot": user_id == SELF_ID}
+
+def member_payload(user_id, role_ids):
+    return {"user": user_payload(user_id), "roles": role_ids, "joined_at": "2023-01-01T00:00:00+00:00",
+            "deaf": False, "mute": False, "flags": 0}
+
+def guild_payload(rng, guild_id, args):
+    role_ids = [str(guild_id)] + [str(guild_id * 1000 + i) for i in range(1, args.roles)]
+    roles = [{"id": role_id, "name": f"role{i}", "permissions": "104324673", "position": i, "color": 0,
+              "hoist": False, "managed": False, "mentionable": False, "flags": 0}
+             for i, role_id in enumerate(role_ids)]
+    channels = [{"id": str(guild_id * 100000 + i), "type": 0, "name": f"channel{i}", "position": i,
+                 "permission_overwrites": [{"id": rng.choice(role_ids), "type": 0, "allow": "1024", "deny": "2048"}],
+                 "nsfw": False, "parent_id": None, "rate_limit_per_user": 0, "topic": None}
+                for i in range(args.channels)]
+    # Without the members intent Discord only sends a few members, and always the bot itself
+    members = [member_payload(SELF_ID, role_ids[1:2])] + [
+        member_payload(guild_id * 1000000 + i, [rng.choice(role_ids)]) for i in range(args.members)]
+    emojis = [{"id": str(guild_id * 10000 + i), "name": f"emoji{i}", "roles": [], "require_colons": True,
+               "managed": False, "animated": False, "available": True}
+              for i in range(args.emojis)]
+    return {
+        "id": str(guild_id), "name": f"guild{guild_id}", "icon": None, "owner_id": str(guild_id * 1000000),
+        "member_count": 5000, "large": True, "features": [], "verification_level": 0,
+        "default_message_notifications": 0, "explicit_content_filter": 0, "mfa_level": 0,
+        "nsfw_level": 0, "premium_tier": 0, "preferred_locale": "en-US", "system_channel_flags": 0,
+        "roles": roles, "emojis": emojis, "stickers": [], "channels": channels, "threads": [],
+        "members": members, "voice_states": [], "presences": [], "stage_instances": [],
+        "guild_scheduled_events": [], "joined_at": "2023-01-01T00:00:00+00:00",
+    }
+
+def message_payload(rng, guild_id, args, message_id):
+    author_id = guild_id * 1000000 + rng.randint(0, 10000)
+    return {
+        "id": str(message_id), "channel_id": str(guild_id * 100000 + rng.randrange(args.channels)),
+        "guild_id": str(guild_id), "author": user_payload(author_id),
+        "member": {"roles": [], "joined_at": "2023-01-01T00:00:00+00:00", "deaf": False, "mute": False, "flags": 0},
+        "content": "check this out https://x.com/user/status/1234567890123456789 " + "lorem ipsum " * rng.randint(0, 10),
+        "timestamp": "2024-01-01T00:00:00+00:00", "edited_timestamp": None, "tts": False,
+        "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [],
+        "embeds": [], "pinned": False, "type": 0, "flags": 0,
+    }
+
+def measure(args):
+    # Runs inside the child process, configured by LEAN_CLIENT in its environment
+    sys.path.insert(0, ROOT)
+    import main
+
+    state = main.client._connection
+    state.dispatch = lambda *args, **kwargs: None
+    state.user = state.store_user(user_payload(SELF_ID))
+    state._get_websocket = lambda *args, **kwargs: None
+
+    rng = random.Random(args.seed)
+    gc.collect()
+    baseline = rss_kib()
+
+    for guild_id in range(1, args.guilds + 1):
+        state._add_guild_from_data(guild_payload(rng, guild_id, args))
+    gc.collect()
+    after_guilds = rss_kib()
+
+    for message_id in range(args.messages):
+        state.parse_message_create(message_payload(rng, rng.randint(1, args.guilds), args, 10**17 + message_id))
+    gc.collect()
+    after_messages = rss_kib()
+
+    guild = state._get_guild(1)
+    channel = guild.get_channel(100000)
+    return {
+        "lean": main.LEAN_CLIENT,
+        "guilds": len(state._guilds),
+        "cached_members": sum(len(guild._members) for guild in state._guilds.values()),
+        "cached_messages": len(state._messages or ()),
+        "self_member_cached": guild.me is not None,
+        "permissions_resolved": channel.permissions_for(guild.me).send_messages,
+        "guild_cache_mib": (after_guilds - baseline) / 1024,
+        "message_cache_mib": (after_messages - after_guilds) / 1024,
+        "rss_mib": after_messages / 1024,
+    }
+
+def run_profile(lean, argv):
+    env = dict(os.environ, LEAN_CLIENT="1" if lean else "0")
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"] + argv, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare resident memory of the default and lean client profiles")
+    parser.add_argument("--guilds", type=int, default=2500, help="Guilds on the simulated shard")
+    parser.add_argument("--channels", type=int, default=30, help="Text channels per guild")
+    parser.add_argument("--roles", type=int, default=20, help="Roles per guild")
+    parser.add_argument("--members", type=int, default=50, help="Members besides the bot in each GUILD_CREATE")
+    parser.add_argument("--emojis", type=int, default=30, help="Emojis per guild")
+    parser.add_argument("--messages", type=int, default=20000, help="Messages received after startup")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args, argv = parser.parse_known_args()
+
+    if args.child:
+        print(json.dumps(measure(args)))
+        return
+
+    argv = [arg for arg in sys.argv[1:] if arg != "--json" and arg != args.json]
+    results = {"default": run_profile(False, argv), "lean": run_profile(True, argv)}
+    for key in results["default"]:
+        default, lean = results["default"][key], results["lean"][key]
+        if isinstance(default, float):
+            print(f"{key:>22}: {default:10,.1f} default {lean:10,.1f} lean")
+        else:
+            print(f"{key:>22}: {default!s:>10} default {lean!s:>10} lean")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
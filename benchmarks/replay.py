@@ -0,0 +1,291 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import types
+from collections import Counter
+
+# Replays a message corpus through the bot's real on_message path without a bot token.
+# Discord is replaced by in-process channels and messages whose REST calls sleep for a
+# simulated latency and sometimes answer with a 429.
+#
+#   python benchmarks/replay.py --synthetic 20000 --guilds 500
+#   python benchmarks/replay.py --corpus messages.jsonl --json after.json --baseline before.json
+#   python benchmarks/replay.py --runtime fast --baseline default.json
+#
+# Each message arrives as a MESSAGE_CREATE gateway payload and is decoded the way the
+# gateway decodes it, so the runtime profiles can be compared: --runtime default runs on
+# asyncio's event loop with the json module, --runtime fast on uvloop with orjson (when
+# installed, see requirements-speed.txt).
+#
+# A corpus is JSONL with one message per line: {"guild": 1, "channel": 2, "content": "..."}
+# and optionally "bot": true.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE_LINKS = [
+    "https://x.com/{user}/status/{id}",
+    "https://twitter.com/{user}/status/{id}",
+    "https://www.instagram.com/reel/C{id}/",
+    "https://reddit.com/r/{user}/comments/{id}/some_title",
+    "https://www.reddit.com/r/{user}/s/{id}",
+    "https://www.threads.net/@{user}/post/C{id}",
+    "https://www.pixiv.net/en/artworks/{id}",
+    "https://bsky.app/profile/{user}.bsky.social/post/{id}",
+]
+
+SAMPLE_TEXT = [
+    "lol", "did you see this", "ok", "that's wild", "anyone up for a game tonight?",
+    "check https://example.com/page", "brb", "gg", "same", "I can't believe it",
+]
+
+def synthetic_corpus(count, guilds, link_ratio, seed):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        # A few guilds carry most of the traffic, as in production
+        guild = int(rng.paretovariate(1.2)) % guilds + 1
+        channel = guild * 1000 + rng.randint(0, 9)
+        content = rng.choice(SAMPLE_TEXT)
+        if rng.random() < link_ratio:
+            links = [rng.choice(SAMPLE_LINKS).format(user=f"user{rng.randint(1, 500)}", id=rng.randint(10**9, 10**10))
+                     for _ in range(rng.choice((1, 1, 1, 2, 3)))]
+            content = f"{content} {' '.join(links)}"
+            if rng.random() < 0.05:
+                content = f"<{links[0]}>"
+        corpus.append({"guild": guild, "channel": channel, "content": content, "bot": rng.random() < 0.05})
+    return corpus
+
+def gateway_payload(entry, message_id):
+    author_id = entry["channel"] * 1000 + message_id % 1000
+    return json.dumps({"op": 0, "s": message_id, "t": "MESSAGE_CREATE", "d": {
+        "id": str(10**17 + message_id), "channel_id": str(entry["channel"]), "guild_id": str(entry["guild"]),
+        "author": {"id": str(author_id), "username": f"user{author_id}", "discriminator": "0", "global_name": None,
+                   "avatar": "a" * 32, "bot": entry.get("bot", False)},
+        "member": {"roles": [str(entry["guild"])], "joined_at": "2023-01-01T00:00:00+00:00", "deaf": False, "mute": False, "flags": 0},
+        "content": entry["content"], "timestamp": "2024-01-01T00:00:00+00:00", "edited_timestamp": None,
+        "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [],
+        "embeds": [], "components": [], "pinned": False, "type": 0, "flags": 0, "nonce": str(message_id)}})
+
+def load_corpus(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+class FakeResponse:
+
+    def __init__(self, status, reason, headers):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+class FakeDiscord:
+    # Stands in for Discord's REST API: every call takes `latency` seconds on average and
+    # fails with a 429 with probability `rate_limit_chance`
+
+    def __init__(self, discord, latency, rate_limit_chance, retry_after, seed):
+        self.discord = discord
+        self.latency = latency
+        self.rate_limit_chance = rate_limit_chance
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.rate_limited = 0
+
+    async def call(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+        if self.rng.random() < self.rate_limit_chance:
+            self.rate_limited += 1
+            response = FakeResponse(429, "Too Many Requests", {"Retry-After": str(self.retry_after)})
+            raise self.discord.HTTPException(response, {"message": "You are being rate limited.", "code": 0})
+
+class FakeChannel:
+
+    def __init__(self, fake_discord, channel_id, guild):
+        self.fake_discord = fake_discord
+        self.id = channel_id
+        self.guild = guild
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        await self.fake_discord.call()
+        self.sent += 1
+        return types.SimpleNamespace(jump_url=f"https://discord.com/channels/{self.guild.id}/{self.id}/{self.sent}")
+
+class FakeMessage:
+
+    def __init__(self, fake_discord, message_id, channel, payload, bot):
+        self.fake_discord = fake_discord
+        self.id = message_id
+        self.channel = channel
+        self.guild = channel.guild
+        self.payload = payload
+        self.content = None
+        self.author = types.SimpleNamespace(bot=bot, id=1, mention="<@1>", display_name="user")
+
+    async def delete(self):
+        await self.fake_discord.call()
+
+    async def edit(self, **kwargs):
+        await self.fake_discord.call()
+
+    async def add_reaction(self, emoji):
+        await self.fake_discord.call()
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def replay(main, discord, corpus, fake_discord, concurrency, finished):
+    guilds = {}
+    channels = {}
+    for entry in corpus:
+        guild = guilds.setdefault(entry["guild"], types.SimpleNamespace(id=entry["guild"], shard_id=0))
+        channels.setdefault(entry["channel"], FakeChannel(fake_discord, entry["channel"], guild))
+    messages = [FakeMessage(fake_discord, message_id, channels[entry["channel"]], gateway_payload(entry, message_id),
+                            entry.get("bot", False))
+                for message_id, entry in enumerate(corpus, 1)]
+
+    # Latency runs until on_message returns, or until the link queue has delivered the
+    # message's fixed links
+    started = {}
+    handled = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handle(message):
+        async with semaphore:
+            started[message] = time.perf_counter()
+            message.content = discord.utils._from_json(message.payload)["d"]["content"]
+            await main.on_message(message)
+            handled[message] = time.perf_counter()
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    await asyncio.gather(*(handle(message) for message in messages))
+    await main.link_queue.join()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    latencies = [finished.get(message, handled[message]) - started[message] for message in messages]
+    # Fairness: the busiest guild against guilds sending under 1% of the messages
+    guild_messages = Counter(message.guild.id for message in messages)
+    busiest = guild_messages.most_common(1)[0][0]
+    busiest_latencies = [latency for message, latency in zip(messages, latencies) if message.guild.id == busiest]
+    quiet_latencies = [latency for message, latency in zip(messages, latencies)
+                       if guild_messages[message.guild.id] < len(messages) / 100] or [0]
+
+    return {
+        "messages": len(messages),
+        "guilds": len(guilds),
+        "messages_per_second": len(messages) / wall,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p99_ms_busiest_guild": percentile(busiest_latencies, 0.99) * 1000,
+        "p99_ms_quiet_guilds": percentile(quiet_latencies, 0.99) * 1000,
+        "shed_jobs": main.link_queue.shed,
+        "rest_calls_per_message": fake_discord.calls / len(messages),
+        "rate_limited_calls": fake_discord.rate_limited,
+        "cpu_ms_per_1k_messages": cpu / len(messages) * 1000 * 1000,
+    }
+
+def load_bot(args):
+    # The bot reads its configuration on import
+    os.environ["DATABASE_PATH"] = os.path.join(args.workdir, "replay.db")
+    os.environ["FAST_RUNTIME"] = "1" if args.runtime == "fast" else "0"
+    sys.path.insert(0, ROOT)
+    import discord
+    import main
+
+    main.install_fast_runtime()
+    if args.runtime == "default":
+        # The default image does not install orjson
+        discord.utils._from_json = json.loads
+        discord.utils.HAS_ORJSON = False
+    return main
+
+async def run(main, args):
+    import discord
+
+    main.client.db = await main.init_db()
+    main.client.db_writer = main.DatabaseWriter(main.client.db)
+    main.client.db_writer.start()
+
+    async def process_commands(message):
+        pass
+
+    main.client.process_commands = process_commands
+    if args.trace:
+        main.tracing.tracer.configure(args.trace, args.trace_sample_rate, main.TRACE_MAX_BYTES, main.TRACE_BACKUPS, 0)
+
+    finished = {}
+
+    async def process_job(job):
+        await main.process_job(job)
+        finished[job.message] = time.perf_counter()
+
+    workers = main.link_queue.start(main.LINK_WORKERS, process_job)
+
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+    else:
+        corpus = synthetic_corpus(args.synthetic, args.guilds, args.link_ratio, args.seed)
+    fake_discord = FakeDiscord(discord, args.latency / 1000, args.rate_limit_chance, args.retry_after, args.seed)
+
+    try:
+        return await replay(main, discord, corpus, fake_discord, args.concurrency, finished)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await main.client.db_writer.close()
+        await main.client.db.close()
+
+def print_report(results, baseline):
+    for key, value in results.items():
+        line = f"{key:>26}: {value:,.3f}" if isinstance(value, float) else f"{key:>26}: {value:,}"
+        if baseline and key in baseline and baseline[key]:
+            line += f"  ({(value - baseline[key]) / baseline[key] * 100:+.1f}% vs baseline)"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay messages through on_message against a simulated Discord")
+    parser.add_argument("--corpus", help="JSONL message corpus to replay")
+    parser.add_argument("--synthetic", type=int, default=10000, help="Number of synthetic messages when no corpus is given")
+    parser.add_argument("--guilds", type=int, default=200, help="Number of guilds in the synthetic corpus")
+    parser.add_argument("--link-ratio", type=float, default=0.2, help="Share of synthetic messages containing links")
+    parser.add_argument("--latency", type=float, default=50, help="Mean simulated REST latency in milliseconds")
+    parser.add_argument("--rate-limit-chance", type=float, default=0.01, help="Probability of a REST call returning 429")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="Retry-After of simulated 429s in seconds")
+    parser.add_argument("--concurrency", type=int, default=500, help="Messages handled at the same time")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--runtime", choices=("default", "fast"), default="default",
+                        help="default: asyncio event loop and json; fast: uvloop and orjson where installed")
+    parser.add_argument("--trace", help="Write trace spans to this JSONL file")
+    parser.add_argument("--trace-sample-rate", type=float, default=1, help="Share of messages traced with --trace")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Compare against results written by an earlier --json run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        args.workdir = workdir
+        bot = load_bot(args)
+        print(f"Runtime: {bot.runtime_description()}")
+        results = asyncio.run(run(bot, args))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import json
+from dotenv import load_dotenv
+
+# Starts the bot as several worker processes ("clusters"), each running a contiguous
+# range of the shards, and restarts workers that crash or stop reporting health.
+
+# Initialize logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [launcher] %(message)s')
+
+# Loading configuration from .env
+load_dotenv()
+
+# Cluster configuration
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 10))
+CLUSTER_COUNT = max(1, min(int(os.getenv('CLUSTER_COUNT', os.cpu_count() or 1)), SHARD_COUNT))
+HEALTH_DIR = os.getenv('HEALTH_DIR', '.cluster')
+
+# Discord allows `max_concurrency` shard logins every 5 seconds across all processes,
+# so each worker starts once the shards of the previous ones have had time to log in
+IDENTIFY_CONCURRENCY = int(os.getenv('IDENTIFY_CONCURRENCY', 1))
+IDENTIFY_INTERVAL = 5
+
+CHECK_INTERVAL = 5  # Seconds between health checks
+STATUS_INTERVAL = 60  # Seconds between status summaries in the log
+HEALTH_TIMEOUT = 120  # A worker that has not reported for this long is restarted
+STARTUP_GRACE = 300  # Seconds a new worker has to log in and send its first report
+RESTART_DELAY = 5  # Doubles while a worker keeps crashing, up to MAX_RESTART_DELAY
+MAX_RESTART_DELAY = 300
+STABLE_UPTIME = 600  # A worker that ran this long before failing restarts right away
+STOP_TIMEOUT = 30  # Seconds a worker gets to exit before it is killed
+
+def split_shards(shard_count, cluster_count):
+    # Contiguous shard ranges, as even as possible
+    size, extra = divmod(shard_count, cluster_count)
+    clusters = []
+    start = 0
+    for cluster_id in range(cluster_count):
+        end = start + size + (1 if cluster_id < extra else 0)
+        clusters.append(list(range(start, end)))
+        start = end
+    return clusters
+
+class Worker:
+
+    def __init__(self, cluster_id, shard_ids):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.health_file = os.path.join(HEALTH_DIR, f'cluster-{cluster_id}.json')
+        self.process = None
+        self.started = 0
+        self.restart_delay = RESTART_DELAY
+        self.restart_at = None
+
+    def start(self):
+        try:
+            os.remove(self.health_file)
+        except FileNotFoundError:
+            pass
+        env = dict(
+            os.environ,
+            SHARD_COUNT=str(SHARD_COUNT),
+            SHARD_IDS=','.join(str(shard_id) for shard_id in self.shard_ids),
+            CLUSTER_ID=str(self.cluster_id),
+            HEALTH_FILE=self.health_file)
+        self.process = subprocess.Popen([sys.executable, MAIN_SCRIPT], env=env)
+        self.started = time.monotonic()
+        self.restart_at = None
+        logging.info(f'Started cluster {self.cluster_id} (shards {self.shard_ids[0]}-{self.shard_ids[-1]}, pid {self.process.pid})')
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logging.warning(f'Cluster {self.cluster_id} did not stop in time, killing it')
+            self.process.kill()
+            self.process.wait()
+
+    def read_health(self):
+        try:
+            with open(self.health_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def check(self):
+        # Returns why the worker needs a restart, or None if it is healthy
+        code = self.process.poll()
+        if code is not None:
+            return f'exited with code {code}'
+        health = self.read_health()
+        if health is None:
+            if time.monotonic() - self.started > STARTUP_GRACE:
+                return 'never reported its health'
+            return None
+        age = time.time() - health['time']
+        if age > HEALTH_TIMEOUT:
+            return f'has not reported for {age:.0f}s'
+        if health.get('closed'):
+            return 'lost its gateway connection'
+        return None
+
+    def schedule_restart(self, reason):
+        logging.warning(f'Cluster {self.cluster_id} {reason}')
+        self.stop()
+        if time.monotonic() - self.started > STABLE_UPTIME:
+            self.restart_delay = RESTART_DELAY
+        self.restart_at = time.monotonic() + self.restart_delay
+        logging.info(f'Restarting cluster {self.cluster_id} in {self.restart_delay}s')
+        self.restart_delay = min(self.restart_delay * 2, MAX_RESTART_DELAY)
+
+def log_status(workers):
+    for worker in workers:
+        health = worker.read_health() if worker.restart_at is None else None
+        if health is None:
+            logging.info(f'Cluster {worker.cluster_id}: starting')
+            continue
+        latencies = [latency for latency in health['shards'].values() if latency == latency and latency != float('inf')]
+        latency = f'{max(latencies) * 1000:.0f}ms' if latencies else 'n/a'
+        logging.info(f"Cluster {worker.cluster_id}: pid {health['pid']}, {health['guilds']} guilds, worst shard latency {latency}")
+
+def main():
+    os.makedirs(HEALTH_DIR, exist_ok=True)
+    workers = [Worker(cluster_id, shard_ids) for cluster_id, shard_ids in enumerate(split_shards(SHARD_COUNT, CLUSTER_COUNT))]
+
+    stopping = False
+
+    def handle_signal(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    start_at = time.monotonic()
+    for worker in workers:
+        worker.restart_at = start_at
+        start_at += IDENTIFY_INTERVAL * len(worker.shard_ids) / IDENTIFY_CONCURRENCY
+
+    last_status = time.monotonic()
+    while not stopping:
+        now = time.monotonic()
+        for worker in workers:
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    worker.start()
+                continue
+            reason = worker.check()
+            if reason:
+                worker.schedule_restart(reason)
+
+        if now - last_status >= STATUS_INTERVAL:
+            log_status(workers)
+            last_status = now
+        time.sleep(CHECK_INTERVAL)
+
+    logging.info('Stopping clusters')
+    for worker in workers:
+        if worker.process is not None and worker.process.poll() is None:
+            worker.process.terminate()
+    for worker in workers:
+        worker.stop()
+
+if __name__ == '__main__':
+    main()
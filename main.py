@@ -2,16 +2,25 @@ import logging
 import asyncio
 from discord.ext import commands, tasks
 from discord import app_commands, ui
-from typing import Optional
+from typing import Optional, NamedTuple
 import discord
 import re
 import os
 from dotenv import load_dotenv
 import itertools
+import ast
+import json
 import aiosqlite
+import aiohttp
+import metrics
+import tracing
 import sqlite3
 import time
-from collections import deque
+import hashlib
+import contextlib
+import signal
+import platform
+from collections import Counter, OrderedDict, deque
 
 # Version number
 VERSION = "1.1.7"
@@ -19,39 +28,1140 @@ VERSION = "1.1.7"
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 
-# Bot configuration
-intents = discord.Intents.default()
+# Loading configuration from .env
+load_dotenv()
+
+# Bot configuration. The lean profile only subscribes to what link fixing needs (guilds
+# for channels, roles and permissions, guild messages and their content) and keeps no
+# message or member cache; the bot's own member is always cached, so permission checks
+# still work. See benchmarks/memory.py for the difference in resident memory.
+LEAN_CLIENT = os.getenv('LEAN_CLIENT', '').lower() in ('1', 'true', 'yes')
+if LEAN_CLIENT:
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    client_options = {
+        "max_messages": None,
+        "member_cache_flags": discord.MemberCacheFlags.none(),
+        "chunk_guilds_at_startup": False,
+    }
+else:
+    intents = discord.Intents.default()
+    client_options = {}
 intents.message_content = True
-client = commands.Bot(command_prefix='/', intents=intents, shard_count=10)
 
-# In-memory storage for channel states and settings
+# Fast runtime profile. With FAST_RUNTIME set the bot runs on uvloop, and discord.py
+# decodes gateway payloads with orjson whenever it is installed. Both come with
+# requirements-speed.txt; without them the bot keeps asyncio's event loop and the json
+# module. See `benchmarks/replay.py --runtime` for the difference in CPU time.
+FAST_RUNTIME = os.getenv('FAST_RUNTIME', '').lower() in ('1', 'true', 'yes')
+
+def install_fast_runtime():
+    # Must run before the event loop is created
+    if not FAST_RUNTIME:
+        return
+    try:
+        import uvloop
+    except ImportError:
+        logging.warning("FAST_RUNTIME is set but uvloop is not installed, using the asyncio event loop")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+def runtime_description():
+    loop = asyncio.get_event_loop_policy().__class__.__module__.split('.')[0]
+    decoder = "orjson" if discord.utils.HAS_ORJSON else "json"
+    return f"Python {platform.python_version()}, {loop} event loop, {decoder} gateway decoding"
+
+# Sharding. launcher.py starts one worker process per cluster, each running the shards
+# listed in SHARD_IDS; on its own the bot runs every shard.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 10))
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS').split(',')] if os.getenv('SHARD_IDS') else None
+CLUSTER_ID = int(os.getenv('CLUSTER_ID', 0))
+def on_this_worker(guild_id):
+    # Whether the guild is on one of this worker's shards
+    return SHARD_IDS is None or (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+client = commands.AutoShardedBot(command_prefix='/', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, **client_options)
+client.draining = False
+
+# Database shared by every cluster worker
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'fixembed_data.db')
+
+# Where a cluster worker reports its health to the launcher
+HEALTH_FILE = os.getenv('HEALTH_FILE')
+HEALTH_INTERVAL = 15  # Seconds between reports
+
+# In-memory storage for channel states and settings of the guilds loaded by
+# `guild_cache`. Activation is sparse: a guild is active unless `guild_states` says
+# otherwise, and `channel_states` only holds the channels of a guild
+# ({guild_id: {channel_id: state}}) that differ from their guild.
+guild_states = {}
 channel_states = {}
 bot_settings = {}
 
-# Rate-limiting configuration
+def is_channel_active(guild_id, channel_id):
+    guild_state = guild_states.get(guild_id, True)
+    overrides = channel_states.get(guild_id)
+    if overrides:
+        return overrides.get(channel_id, guild_state)
+    return guild_state
+
+def is_guild_active(guild_id):
+    # Active in every channel: the guild is active and no channel is switched off
+    return guild_states.get(guild_id, True) and not channel_states.get(guild_id)
+
+def set_channel_state(guild_id, channel_id, state):
+    overrides = channel_states.get(guild_id, {})
+    if state == guild_states.get(guild_id, True):
+        overrides.pop(channel_id, None)
+        update_channel_state(client.db_writer, guild_id, channel_id, None)
+    else:
+        overrides[channel_id] = state
+        update_channel_state(client.db_writer, guild_id, channel_id, state)
+    if overrides:
+        channel_states[guild_id] = overrides
+    else:
+        channel_states.pop(guild_id, None)
+
+def set_guild_state(guild_id, state):
+    # One row for the whole guild; per-channel exceptions are dropped
+    if state:
+        guild_states.pop(guild_id, None)
+    else:
+        guild_states[guild_id] = state
+    channel_states.pop(guild_id, None)
+    update_guild_state(client.db_writer, guild_id, state)
+
+# Supported services. Each entry holds the link pattern (with `host`, `label` and `post`
+# groups, `post` identifying the post within the service), the fixed host that replaces
+# each original host by default, the candidate embed mirrors `mirror_registry` picks
+# from, and the reply label format.
+SERVICES = {
+    "Twitter": {
+        "pattern": r"(?P<host>twitter\.com|x\.com)/(?P<label>\w+)/status/(?P<post>\d+)",
+        "hosts": {"twitter.com": "fxtwitter.com", "x.com": "fixupx.com"},
+        "mirrors": ["fxtwitter.com", "fixupx.com", "vxtwitter.com", "fixvx.com"],
+        "label": "Twitter • {}",
+    },
+    "Instagram": {
+        "pattern": r"(?P<host>instagram\.com)/(?:p|reel)/(?P<label>(?P<post>[\w-]+))",
+        "hosts": {"instagram.com": "g.ddinstagram.com"},
+        "mirrors": ["g.ddinstagram.com", "ddinstagram.com", "kkinstagram.com"],
+        "label": "Instagram • {}",
+    },
+    "Reddit": {
+        "pattern": r"(?P<host>old\.reddit\.com|reddit\.com)/r/(?P<label>\w+)/(?:(?P<post>s/\w+|comments/\w+)(?:/\w+)?)",
+        "hosts": {"reddit.com": "vxreddit.com", "old.reddit.com": "vxreddit.com"},
+        "mirrors": ["vxreddit.com", "rxddit.com"],
+        "label": "Reddit • {}",
+    },
+    "Threads": {
+        "pattern": r"(?P<host>threads\.net)/@(?P<label>[^/]+)/post/(?P<post>[\w-]+)",
+        "hosts": {"threads.net": "fixthreads.net"},
+        "mirrors": ["fixthreads.net", "vxthreads.net"],
+        "label": "Threads • @{}",
+    },
+    "Pixiv": {
+        "pattern": r"(?P<host>pixiv\.net)/(?:en/)?artworks/(?P<label>(?P<post>\d+))",
+        "hosts": {"pixiv.net": "phixiv.net"},
+        "mirrors": ["phixiv.net", "ppxiv.net"],
+        "label": "Pixiv • {}",
+    },
+    "Bluesky": {
+        "pattern": r"(?P<host>bsky\.app)/profile/(?P<post>(?P<label>[^/]+)/post/[\w-]+)",
+        "hosts": {"bsky.app": "bskyx.app"},
+        "mirrors": ["bskyx.app", "fxbsky.app", "bsyy.app"],
+        "label": "Bluesky • {}",
+    },
+}
+
+# Each service has a bit in a guild's `services` mask. Bits are persisted, so new
+# services must be added at the end of SERVICES.
+SERVICE_BITS = {name: 1 << i for i, name in enumerate(SERVICES)}
+ALL_SERVICES = sum(SERVICE_BITS.values())
+
+# What to do when a link to a post that was fixed recently in the same channel is posted
+# again. The index is persisted.
+REPOST_POLICIES = ["Send Again", "Skip", "React", "Reply"]
+REPOST_SEND, REPOST_SKIP, REPOST_REACT, REPOST_REPLY = range(len(REPOST_POLICIES))
+
+# How fixed links are delivered: a reply with the original's embeds suppressed, a repost
+# by the bot, or a repost through a channel webhook under the author's name and avatar.
+# Stored as the delete_original and webhook_delivery settings.
+DELIVERY_METHODS = ["Suppress Embeds", "Repost", "Webhook"]
+DELIVERY_SUPPRESS, DELIVERY_REPOST, DELIVERY_WEBHOOK = range(len(DELIVERY_METHODS))
+
+class GuildSettings(NamedTuple):
+    services: int = ALL_SERVICES
+    mention_users: bool = True
+    delete_original: bool = True
+    repost_policy: int = REPOST_SEND
+    pinned_mirrors: tuple = ()  # (service, mirror) pairs that override the mirror choice
+    webhook_delivery: bool = False  # Reposts go through a webhook; only used with delete_original
+
+    @property
+    def delivery_method(self):
+        if not self.delete_original:
+            return DELIVERY_SUPPRESS
+        return DELIVERY_WEBHOOK if self.webhook_delivery else DELIVERY_REPOST
+
+    def service_enabled(self, service):
+        return bool(self.services & SERVICE_BITS[service])
+
+# Shared by every guild that has never changed anything; those guilds have no entry in
+# bot_settings
+DEFAULT_SETTINGS = GuildSettings()
+
+def get_guild_settings(guild_id):
+    return bot_settings.get(guild_id, DEFAULT_SETTINGS)
+
+def set_guild_settings(guild_id, settings):
+    if settings == DEFAULT_SETTINGS:
+        bot_settings.pop(guild_id, None)
+    else:
+        bot_settings[guild_id] = settings
+    update_setting(client.db_writer, guild_id, settings)
+
+# One alternation with a named group per service, so a single scan tells us which
+# service matched (`lastgroup`) along with its host, label and post.
+LINK_PATTERN = re.compile(r"https?://(?:www\.)?(?:" + "|".join(
+    f"(?P<{name}>"
+    + service["pattern"].replace("(?P<host>", f"(?P<{name}_host>").replace("(?P<label>", f"(?P<{name}_label>").replace("(?P<post>", f"(?P<{name}_post>")
+    + ")"
+    for name, service in SERVICES.items()) + ")")
+
+# Markdown that decides which links are fixed: nothing in code is a link, links wrapped in
+# < > have their embed suppressed on purpose, and links in ||spoilers|| are fixed but
+# stay spoilered. Code takes precedence, so || and < > inside it mean nothing.
+MARKDOWN_PATTERN = re.compile(r"(?P<code>```.*?```|``.+?``|`[^`]+`)|(?P<spoiler>\|\|)|(?P<suppressed><https?://[^\s<>]+>)", re.DOTALL)
+
+def link_spans(content):
+    # Splits the content in one pass into the (start, end, spoiler) spans where links count
+    spans = []
+    start = 0
+    spoiler = False
+    opened = 0  # First span inside the open spoiler
+    for match in MARKDOWN_PATTERN.finditer(content):
+        if match.start() > start:
+            spans.append((start, match.start(), spoiler))
+        start = match.end()
+        if match.lastgroup == "spoiler":
+            spoiler = not spoiler
+            opened = len(spans)
+    if start < len(content):
+        spans.append((start, len(content), spoiler))
+    if spoiler:
+        # A || that is never closed is not a spoiler
+        spans[opened:] = [(span_start, span_end, False) for span_start, span_end, _ in spans[opened:]]
+    return spans
+
+class FixedLink(NamedTuple):
+    service: str
+    display_text: str
+    url: str
+    post_id: str
+    spoiler: bool = False
+
+    def markdown(self):
+        link = f"[{self.display_text}]({self.url})"
+        return f"||{link}||" if self.spoiler else link
+
+def fix_links(content, services, pinned_mirrors=(), rules=None):
+    fixed_links = []
+    for start, end, spoiler in link_spans(content):
+        for match in LINK_PATTERN.finditer(content, start, end):
+            service = match.lastgroup
+            if not services & SERVICE_BITS[service]:
+                continue
+            host = match.group(f"{service}_host")
+            fixed_host = mirror_registry.select(service, host, pinned_mirrors)
+            display_text = SERVICES[service]["label"].format(match.group(f"{service}_label"))
+            url = f"https://{fixed_host}{content[match.end(f'{service}_host'):match.end()]}"
+            fixed_links.append((match.start(), FixedLink(service, display_text, url, match.group(f"{service}_post"), spoiler)))
+        if rules:
+            fixed_links.extend(rules.fix_links(content, start, end, spoiler))
+    if rules:
+        fixed_links.sort(key=lambda link: link[0])
+    return [fixed_link for _, fixed_link in fixed_links]
+
+# Custom rewrite rules: a guild can map any other host to a fixer host (e.g. tiktok.com to
+# vxtiktok.com). Rules are plain hosts, never patterns. A link's host is looked up
+# together with its parent domains, so a rule also covers subdomains (vm.tiktok.com
+# becomes vm.vxtiktok.com) and matching costs one dict lookup per label of the host, no
+# matter how many rules a guild has.
+MAX_REWRITE_RULES = 20
+# Hosts show up in select options (100 characters, with "→ " before the target) and, for
+# every rule, twice in the panel's embed description (4096 characters)
+MAX_HOST_LENGTH = 80
+CUSTOM_SERVICE = "Custom"
+HOST_PATTERN = re.compile(r"(?=.{4,253}$)(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63}")
+# Any link; only links whose host has a rule are rewritten
+CUSTOM_LINK_PATTERN = re.compile(r"https?://(?:www\.)?(?P<host>[A-Za-z0-9.-]{1,253})(?P<path>/[^\s<>|()\[\]]*)?")
+
+# Compiled rules of the loaded guilds that have any, and every guild with rules, which
+# the gate lets through even without a built-in service's host
+rewrite_rules = {}
+rule_guilds = set()
+
+class RewriteRules:
+
+    def __init__(self, rules):
+        self.targets = dict(rules)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def items(self):
+        return sorted(self.targets.items())
+
+    def target(self, host):
+        # The rule for the host or its closest parent domain, applied to that part
+        start = 0
+        while start >= 0:
+            target = self.targets.get(host[start:])
+            if target is not None:
+                return host[:start] + target
+            start = host.find(".", start)
+            start = start + 1 if start >= 0 else -1
+        return None
+
+    def fix_links(self, content, start, end, spoiler):
+        # Returns (position, fixed link) pairs for the links in content[start:end]
+        fixed_links = []
+        for match in CUSTOM_LINK_PATTERN.finditer(content, start, end):
+            host = match.group("host").lower().rstrip(".")
+            fixed_host = self.target(host)
+            if fixed_host is None:
+                continue
+            # Punctuation ending a sentence is not part of the link
+            path = (match.group("path") or "").rstrip(".,!?:;")
+            fixed_links.append((match.start(), FixedLink(CUSTOM_SERVICE, host, f"https://{fixed_host}{path}", host + path, spoiler)))
+        return fixed_links
+
+def normalize_host(value):
+    host = value.strip().lower()
+    for prefix in ("https://", "http://", "www."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    return host.split("/")[0]
+
+def check_rewrite_rule(rules, source, target):
+    # Returns why the rule can't be added, or None
+    for host in (source, target):
+        if len(host) > MAX_HOST_LENGTH:
+            return f"Hosts can be at most {MAX_HOST_LENGTH} characters long."
+        if not HOST_PATTERN.fullmatch(host):
+            return f"`{host}` is not a valid host."
+    if source == target:
+        return "A host can't be rewritten to itself."
+    if source in GATE_HOSTS:
+        return f"`{source}` is a built-in service; choose its mirror under Mirrors instead."
+    if source not in rules and len(rules) >= MAX_REWRITE_RULES:
+        return f"A server can have at most {MAX_REWRITE_RULES} rewrite rules."
+    return None
+
+async def refresh_rule_guild(db, guild_id):
+    # Another process may have changed the rules of a guild that is not loaded here
+    async with db.execute('SELECT 1 FROM rewrite_rules WHERE guild_id = ? LIMIT 1', (guild_id,)) as cursor:
+        if await cursor.fetchone():
+            rule_guilds.add(guild_id)
+        else:
+            rule_guilds.discard(guild_id)
+
+def set_rewrite_rules(guild_id, rules):
+    if rules:
+        rewrite_rules[guild_id] = RewriteRules(rules)
+        rule_guilds.add(guild_id)
+    else:
+        rewrite_rules.pop(guild_id, None)
+        rule_guilds.discard(guild_id)
+    update_rewrite_rules(client.db_writer, guild_id, rules)
+
+# Embed mirrors are probed in the background when MIRROR_PROBE_INTERVAL is set. Each
+# service uses its fastest healthy mirror and only switches when the current one fails or
+# becomes clearly slower, so links don't flap between mirrors. Until a service has a
+# healthy mirror, its default hosts are used. A guild's pinned mirror is used unless it is
+# known to be down.
+MIRROR_PROBE_INTERVAL = int(os.getenv('MIRROR_PROBE_INTERVAL', 0))  # Seconds, 0 disables probing
+MIRROR_PROBE_SCHEME = os.getenv('MIRROR_PROBE_SCHEME', 'https')
+MIRROR_TIMEOUT = 5  # Seconds before a probe counts as failed
+MIRROR_FAILURES = 2  # Consecutive failed probes before a mirror counts as down
+MIRROR_SWITCH_MARGIN = 1.5  # The current mirror is kept until it is this many times slower than the best
+MIRROR_SMOOTHING = 0.3  # Weight of the newest probe in the latency average
+
+class MirrorRegistry:
+
+    def __init__(self, scheme, timeout):
+        self.scheme = scheme
+        self.timeout = timeout
+        self.session = None
+        self.latency = {}  # mirror -> smoothed probe latency in seconds
+        self.failures = Counter()  # mirror -> consecutive failed probes
+        self.active = {}  # service -> mirror in use
+
+    def start(self):
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={"User-Agent": f"FixEmbed/{VERSION}"})
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    def is_down(self, mirror):
+        return self.failures[mirror] >= MIRROR_FAILURES
+
+    def is_healthy(self, mirror):
+        return mirror in self.latency and not self.is_down(mirror)
+
+    def select(self, service, host, pinned_mirrors):
+        for pinned_service, mirror in pinned_mirrors:
+            if pinned_service == service and not self.is_down(mirror):
+                return mirror
+        return self.active.get(service) or SERVICES[service]["hosts"][host]
+
+    async def probe(self, mirror):
+        start = time.perf_counter()
+        try:
+            async with self.session.get(f"{self.scheme}://{mirror}/", allow_redirects=False) as response:
+                healthy = response.status < 500
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            healthy = False
+        if not healthy:
+            self.failures[mirror] += 1
+            return
+        latency = time.perf_counter() - start
+        self.failures.pop(mirror, None)
+        previous = self.latency.get(mirror)
+        self.latency[mirror] = latency if previous is None else previous + MIRROR_SMOOTHING * (latency - previous)
+
+    async def probe_all(self):
+        mirrors = {mirror for service in SERVICES.values() for mirror in service["mirrors"]}
+        await asyncio.gather(*(self.probe(mirror) for mirror in mirrors))
+        self.choose()
+
+    def choose(self):
+        for name, service in SERVICES.items():
+            healthy = [mirror for mirror in service["mirrors"] if self.is_healthy(mirror)]
+            current = self.active.get(name)
+            if not healthy:
+                if current:
+                    logging.warning(f"No healthy {name} mirror, using the default hosts")
+                self.active.pop(name, None)
+                continue
+            best = min(healthy, key=self.latency.get)
+            if current in healthy and self.latency[current] <= self.latency[best] * MIRROR_SWITCH_MARGIN:
+                continue
+            if current != best:
+                logging.info(f"Using {best} for {name} ({self.latency[best] * 1000:.0f}ms)")
+            self.active[name] = best
+
+mirror_registry = MirrorRegistry(MIRROR_PROBE_SCHEME, MIRROR_TIMEOUT)
+
+# Building blocks of the caches below
+NOT_CACHED = object()
+
+class LRUCache:
+    # Keeps at most `max_size` entries and drops the least recently used one past that.
+    # Entries can expire; `on_evict` is called with the key of each dropped entry.
+
+    def __init__(self, max_size, on_evict=None):
+        self.max_size = max_size
+        self.on_evict = on_evict
+        # key -> (expiry, value), least recently used first
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=NOT_CACHED):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic() + ttl if ttl is not None else float("inf"), value)
+        while len(self.entries) > self.max_size:
+            evicted, _ = self.entries.popitem(last=False)
+            if self.on_evict:
+                self.on_evict(evicted)
+
+    def pop(self, key):
+        # Returns whether the key was cached
+        return self.entries.pop(key, None) is not None
+
+class Coalescer:
+    # Concurrent lookups of the same key share one task, which runs to the end even if
+    # the callers waiting on it are cancelled
+
+    def __init__(self):
+        self.tasks = {}
+
+    def get(self, key):
+        return self.tasks.get(key)
+
+    def run(self, key, lookup):
+        task = self.tasks.get(key)
+        if task is None:
+            task = self.tasks[key] = asyncio.create_task(lookup())
+            task.add_done_callback(lambda _: self.tasks.pop(key, None))
+        return asyncio.shield(task)
+
+# Posts fixed recently in each channel, so reposts can be handled per the guild's
+# repost policy instead of sending the fixed link again
+REPOST_TTL = 900  # Seconds a fixed post is remembered
+REPOST_CACHE_SIZE = 100000
+
+class RecentLinks:
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        # (channel_id, service, post_id) -> jump URL of our reply. While the reply is being
+        # sent, a future for its jump URL stands in for it.
+        self.cache = LRUCache(max_size)
+
+    def get(self, key):
+        return self.cache.get(key, None)
+
+    def add(self, key, jump_url):
+        self.cache.set(key, jump_url, self.ttl)
+
+    def release(self, key, claim):
+        if self.cache.get(key, None) is claim:
+            self.cache.pop(key)
+
+recent_links = RecentLinks(REPOST_TTL, REPOST_CACHE_SIZE)
+
+# Reddit share links (reddit.com/r/<sub>/s/<id>) only redirect to the post, so the embed
+# service follows the redirect on every view. With RESOLVE_SHARE_LINKS set, the redirect is
+# followed once here and the fixed link points at the canonical /comments/ URL, which
+# unfurls faster and is recognized as a repost of other links to the same post.
+RESOLVE_SHARE_LINKS = os.getenv('RESOLVE_SHARE_LINKS', '').lower() in ('1', 'true', 'yes')
+SHARE_LINK_ORIGIN = os.getenv('SHARE_LINK_ORIGIN', 'https://www.reddit.com')
+RESOLVE_CONCURRENCY = 10  # Lookups in flight at once
+RESOLVE_TIMEOUT = 5  # Seconds before a lookup is abandoned and the share link kept
+RESOLVE_TTL = 86400  # Seconds a resolved share link is remembered
+RESOLVE_CACHE_SIZE = 50000
+CANONICAL_POST_PATTERN = re.compile(r"/r/\w+/comments/(?P<post>\w+)(?:/\w+)?")
+
+class ShareLinkResolver:
+
+    def __init__(self, origin, concurrency, timeout, ttl, max_size):
+        self.origin = origin
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.ttl = ttl
+        self.session = None
+        self.semaphore = None
+        # share link path -> canonical path or None
+        self.cache = LRUCache(max_size)
+        # Identical links share one request
+        self.pending = Coalescer()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def start(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            connector=aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300),
+            headers={"User-Agent": f"FixEmbed/{VERSION}"})
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def resolve(self, path):
+        # Returns the canonical path of a share link path, or None if it did not resolve
+        canonical = self.cache.get(path)
+        if canonical is not NOT_CACHED:
+            self.hits += 1
+            return canonical
+        self.misses += 1
+        return await self.pending.run(path, lambda: self.fetch(path))
+
+    async def fetch(self, path):
+        try:
+            async with self.semaphore:
+                async with self.session.get(self.origin + path, allow_redirects=False) as response:
+                    status = response.status
+                    location = response.headers.get("Location", "")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Failures are not cached, so the next message retries
+            self.failures += 1
+            logging.error(f"Failed to resolve share link {path}: {e!r}")
+            return None
+        # Only a redirect, a page without one or a 404 say what the link is; anything else
+        # (403, 429, 5xx) is a failure
+        if not (300 <= status < 400 or 200 <= status < 300 or status == 404):
+            self.failures += 1
+            logging.error(f"Failed to resolve share link {path}: HTTP {status}")
+            return None
+
+        match = CANONICAL_POST_PATTERN.search(location)
+        canonical = match.group(0) if match else None
+        self.cache.set(path, canonical, self.ttl)
+        return canonical
+
+share_link_resolver = ShareLinkResolver(SHARE_LINK_ORIGIN, RESOLVE_CONCURRENCY, RESOLVE_TIMEOUT, RESOLVE_TTL, RESOLVE_CACHE_SIZE)
+
+async def resolve_share_links(fixed_links):
+    async def resolve(fixed_link):
+        if fixed_link.service != "Reddit" or not fixed_link.post_id.startswith("s/"):
+            return fixed_link
+        host, path = fixed_link.url.split("://", 1)[1].split("/", 1)
+        canonical = await share_link_resolver.resolve(f"/{path}")
+        if canonical is None:
+            return fixed_link
+        post_id = CANONICAL_POST_PATTERN.match(canonical).group("post")
+        return fixed_link._replace(url=f"https://{host}{canonical}", post_id=f"comments/{post_id}")
+
+    return list(await asyncio.gather(*(resolve(fixed_link) for fixed_link in fixed_links)))
+
+# Hosts that can appear in a supported link. Messages mentioning none of them are
+# rejected before any settings lookup or regex work.
+GATE_HOSTS = tuple(dict.fromkeys(host for service in SERVICES.values() for host in service["hosts"]))
+
+# Counts of messages rejected by the gate, by reason, and of messages let through
+gate_stats = Counter()
+
+def passes_gate(message):
+    if message.author.bot:
+        gate_stats["bot"] += 1
+        return False
+    if message.guild is None:
+        gate_stats["dm"] += 1
+        return False
+    content = message.content
+    if "http" not in content or not (any(host in content for host in GATE_HOSTS) or message.guild.id in rule_guilds):
+        gate_stats["no_link"] += 1
+        return False
+    gate_stats["passed"] += 1
+    return True
+
+# Metrics, served on /metrics when METRICS_PORT is set. Each cluster worker listens on
+# METRICS_PORT + CLUSTER_ID.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+message_seconds = metrics.Histogram("fixembed_on_message_seconds", "Time spent handling a message in on_message")
+rewrite_seconds = metrics.Histogram("fixembed_rewrite_seconds", "Time spent finding and rewriting links in a message")
+rate_limit_wait_seconds = metrics.Histogram("fixembed_rate_limit_wait_seconds", "Time spent waiting for a rate limit slot", ("route",))
+rest_seconds = metrics.Histogram("fixembed_rest_seconds", "Latency of Discord REST calls", ("route",))
+links_fixed = metrics.Counter("fixembed_links_fixed_total", "Links rewritten", ("service",))
+message_outcomes = metrics.Counter("fixembed_messages_total", "Messages that passed the gate, by outcome", ("outcome",))
+queue_wait_seconds = metrics.Histogram("fixembed_queue_wait_seconds", "Time a link job waited in the queue")
+metrics.Callback("fixembed_queue_depth", "Link jobs waiting in the queue", "gauge", lambda: link_queue.depth)
+metrics.Callback("fixembed_queue_active", "Link jobs being delivered", "gauge", lambda: sum(link_queue.active.values()))
+metrics.Callback("fixembed_queue_shed_total", "Link jobs dropped because the queue was full", "counter", lambda: link_queue.shed)
+metrics.Callback("fixembed_gate_total", "Messages seen by the gate, by result", "counter", lambda: dict(gate_stats), ("result",))
+metrics.Callback("fixembed_guild_settings_cached", "Guilds with non-default settings in bot_settings", "gauge", lambda: len(bot_settings))
+metrics.Callback("fixembed_channel_state_guilds_cached", "Guilds with channel overrides in channel_states", "gauge", lambda: len(channel_states))
+metrics.Callback("fixembed_channel_states_cached", "Channel overrides in channel_states", "gauge", lambda: sum(len(overrides) for overrides in channel_states.values()))
+metrics.Callback("fixembed_guild_cache_size", "Guilds loaded in the guild cache", "gauge", lambda: len(guild_cache))
+metrics.Callback("fixembed_guild_cache_total", "Guild cache lookups and removals, by result", "counter", lambda: {
+    "hit": guild_cache.hits, "miss": guild_cache.misses, "eviction": guild_cache.evictions, "invalidation": guild_cache.invalidations}, ("result",))
+metrics.Callback("fixembed_mirror_latency_seconds", "Smoothed probe latency of each embed mirror", "gauge", lambda: dict(mirror_registry.latency), ("mirror",))
+metrics.Callback("fixembed_mirror_up", "Whether each embed mirror is up", "gauge", lambda: {
+    mirror: int(not mirror_registry.is_down(mirror)) for service in SERVICES.values() for mirror in service["mirrors"]}, ("mirror",))
+metrics.Callback("fixembed_share_link_lookups_total", "Share link lookups, by result", "counter", lambda: {
+    "hit": share_link_resolver.hits, "miss": share_link_resolver.misses, "failure": share_link_resolver.failures}, ("result",))
+
+# Sampled tracing of messages and database flushes, see tracing.py. Each cluster worker
+# writes its own file.
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))  # Share of traced messages, 0 disables tracing
+TRACE_FILE = os.getenv('TRACE_FILE', os.path.join('traces', f'cluster-{CLUSTER_ID}.jsonl'))
+TRACE_MAX_BYTES = 50 * 1024 * 1024  # The file is rotated past this size
+TRACE_BACKUPS = 3
+
+# Rate-limiting configuration. Discord rate-limits message calls per channel, so every
+# (route, channel) pair gets its own token bucket and a busy channel never delays others.
 MESSAGE_LIMIT = 5
 TIME_WINDOW = 1  # Time window in seconds
-
-message_timestamps = deque()
-
-async def rate_limited_send(channel, content):
-    current_time = time.time()
-    while len(message_timestamps) >= MESSAGE_LIMIT and current_time - message_timestamps[0] < TIME_WINDOW:
-        await asyncio.sleep(0.1)
-        current_time = time.time()
-        message_timestamps.popleft()
-    message_timestamps.append(current_time)
-    await channel.send(content)
+MAX_BUCKETS = 10000  # Idle buckets are pruned past this size
+
+class RateLimiter:
+    # Token bucket kept as a theoretical arrival time per key (GCRA): up to `limit` calls
+    # go through at once, then one every `window / limit` seconds.
+
+    def __init__(self, limit, window):
+        self.interval = window / limit
+        self.tolerance = window - self.interval
+        self.buckets = {}
+
+    def reserve(self, key):
+        # Claims the next slot for `key` and returns how long to wait before using it
+        now = time.monotonic()
+        arrival = max(self.buckets.get(key, now), now)
+        self.buckets[key] = arrival + self.interval
+        if len(self.buckets) > MAX_BUCKETS:
+            self.prune(now)
+        return max(arrival - self.tolerance - now, 0)
+
+    def block(self, key, retry_after):
+        # Feedback from Discord: nothing goes through for `key` for `retry_after` seconds
+        resume = time.monotonic() + retry_after + self.tolerance
+        self.buckets[key] = max(self.buckets.get(key, 0), resume)
+
+    def prune(self, now):
+        # A bucket whose arrival time has passed is full again, same as a missing one
+        for key in [key for key, arrival in self.buckets.items() if arrival <= now]:
+            del self.buckets[key]
+
+    def dump(self):
+        # The buckets still refilling, with arrival times on the wall clock so they carry
+        # over to the next process
+        now = time.monotonic()
+        offset = time.time() - now
+        return [[route, channel_id, arrival + offset] for (route, channel_id), arrival in self.buckets.items() if arrival > now]
+
+    def load(self, buckets):
+        now = time.monotonic()
+        offset = time.time() - now
+        for route, channel_id, arrival in buckets:
+            if arrival - offset > now:
+                key = (route, channel_id)
+                self.buckets[key] = max(self.buckets.get(key, 0), arrival - offset)
+
+rate_limiter = RateLimiter(MESSAGE_LIMIT, TIME_WINDOW)
+
+def get_retry_after(error):
+    if isinstance(error, discord.RateLimited):
+        return error.retry_after
+    headers = getattr(error.response, "headers", None) or {}
+    for header in ("Retry-After", "X-RateLimit-Reset-After"):
+        try:
+            return float(headers[header])
+        except (KeyError, ValueError):
+            continue
+    return TIME_WINDOW
+
+async def rate_limited(route, channel_id, call, retries=3):
+    key = (route, channel_id)
+    for attempt in range(retries):
+        delay = rate_limiter.reserve(key)
+        rate_limit_wait_seconds.observe(delay, route)
+        if delay:
+            with tracing.span("rate_limit_wait", route=route):
+                await asyncio.sleep(delay)
+        try:
+            with rest_seconds.time(route), tracing.span(route, attempt=attempt):
+                return await call()
+        except (discord.RateLimited, discord.HTTPException) as e:
+            if getattr(e, "status", 429) != 429 or attempt == retries - 1:
+                raise
+            rate_limiter.block(key, get_retry_after(e))
+
+async def rate_limited_send(channel, content, **kwargs):
+    return await rate_limited("send", channel.id, lambda: channel.send(content, **kwargs))
+
+async def rate_limited_edit(message, **kwargs):
+    return await rate_limited("edit", message.channel.id, lambda: message.edit(**kwargs))
+
+async def rate_limited_delete(message):
+    return await rate_limited("delete", message.channel.id, message.delete)
+
+# Webhook delivery. Each channel gets one webhook, created the first time it is needed
+# and kept in the channel_webhooks table, so it outlives restarts and is not created
+# again. Webhook executes are rate-limited per webhook rather than per channel, so they
+# get their own "webhook" bucket next to the bot's "send" bucket.
+WEBHOOK_CACHE_SIZE = int(os.getenv('WEBHOOK_CACHE_SIZE', 10000))
+WEBHOOK_RETRY_INTERVAL = 600  # Seconds before retrying a channel where no webhook could be made
+WEBHOOK_NAME = "FixEmbed"
+# Discord rejects webhook usernames containing these
+RESERVED_WEBHOOK_NAMES = re.compile(r"discord|clyde", re.IGNORECASE)
+
+class WebhookCache:
+
+    def __init__(self, max_size):
+        # channel_id -> webhook, or None for a while where the bot may not manage webhooks
+        # or the webhook failed
+        self.webhooks = LRUCache(max_size)
+        # Concurrent misses for the same channel share one lookup, so only one webhook
+        # gets created
+        self.loading = Coalescer()
+
+    async def get(self, channel):
+        # Returns the channel's webhook, or None if it has none and cannot get one
+        webhook = self.webhooks.get(channel.id)
+        if webhook is not NOT_CACHED:
+            return webhook
+        return await self.loading.run(channel.id, lambda: self.fetch(channel))
+
+    async def fetch(self, channel):
+        # A pending write may delete the channel's row
+        if client.db_writer.pending:
+            await client.db_writer.flush()
+        async with client.db.execute('SELECT webhook_id, token FROM channel_webhooks WHERE channel_id = ?', (channel.id,)) as cursor:
+            row = await cursor.fetchone()
+        if row:
+            webhook = discord.Webhook.partial(row[0], row[1], client=client)
+        else:
+            try:
+                webhook = await self.create(channel)
+            except (discord.Forbidden, discord.HTTPException) as e:
+                logging.error(f"Failed to create webhook in channel {channel.id}: {e}")
+                self.back_off(channel.id)
+                return None
+            client.db_writer.write(("channel_webhook", channel.id), "channel_webhook", (channel.id, channel.guild.id, webhook.id, webhook.token))
+        self.webhooks.set(channel.id, webhook)
+        return webhook
+
+    async def create(self, channel):
+        # A webhook made by an earlier run whose row was lost is reused, as channels
+        # only allow a few webhooks
+        for webhook in await channel.webhooks():
+            if webhook.user == client.user and webhook.token:
+                return webhook
+        return await channel.create_webhook(name=WEBHOOK_NAME, reason="FixEmbed webhook delivery")
+
+    def forget(self, channel_id):
+        # The webhook was deleted in Discord; the next get creates a new one
+        self.webhooks.pop(channel_id)
+        client.db_writer.write(("channel_webhook", channel_id), "delete_channel_webhook", (channel_id,))
+
+    def back_off(self, channel_id):
+        # The webhook failed; the channel is sent to as the bot for a while
+        self.webhooks.set(channel_id, None, WEBHOOK_RETRY_INTERVAL)
+
+webhook_cache = WebhookCache(WEBHOOK_CACHE_SIZE)
+
+def webhook_username(member):
+    name = RESERVED_WEBHOOK_NAMES.sub("", member.display_name).strip()
+    return name[:80] or WEBHOOK_NAME
+
+async def send_webhook_replies(message, replies):
+    # Sends the replies under the author's name and avatar until the channel has no usable
+    # webhook or one fails. Returns the replies sent; the caller sends the rest as the bot.
+    channel = message.channel
+    # Threads post through their parent channel's webhook
+    thread = channel if isinstance(channel, discord.Thread) else discord.utils.MISSING
+    parent = channel.parent if thread else channel
+    sent = []
+    for reply in replies:
+        for attempt in range(2):
+            webhook = await webhook_cache.get(parent)
+            if webhook is None:
+                return sent
+            try:
+                sent.append(await rate_limited("webhook", parent.id, lambda: webhook.send(
+                    reply,
+                    username=webhook_username(message.author),
+                    avatar_url=message.author.display_avatar.url,
+                    thread=thread,
+                    allowed_mentions=discord.AllowedMentions.none(),
+                    wait=True)))
+                break
+            except discord.NotFound:
+                webhook_cache.forget(parent.id)
+                if attempt:
+                    return sent
+            except (discord.HTTPException, discord.RateLimited) as e:
+                logging.error(f"Failed to send through the webhook of channel {parent.id}: {e}")
+                # A 400 is about this message (e.g. a username Discord rejects), not the webhook
+                if getattr(e, "status", None) != 400:
+                    webhook_cache.back_off(parent.id)
+                return sent
+    return sent
+
+# Discord's message length limit
+MAX_MESSAGE_LENGTH = 2000
+
+def build_replies(lines, suffix=""):
+    # Packs the lines into as few messages as fit, each one ending with `suffix`
+    replies = []
+    current = ""
+    for line in lines:
+        if current and len(current) + 1 + len(line) + len(suffix) > MAX_MESSAGE_LENGTH:
+            replies.append(current + suffix)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        replies.append(current + suffix)
+    return replies
+
+async def send_replies(channel, replies):
+    return [await rate_limited_send(channel, reply) for reply in replies]
+
+async def send_reposts(message, lines, suffix):
+    replies = build_replies(lines)
+    sent = await send_webhook_replies(message, replies)
+    if len(sent) < len(replies):
+        rest = [line for reply in replies[len(sent):] for line in reply.split("\n")]
+        sent += await send_replies(message.channel, build_replies(rest, suffix))
+    return sent
+
+async def deliver_fixed_links(message, fixed_links, delivery_method, mention_users):
+    # One reply carries every fixed link. Embed suppression of the original message runs
+    # alongside it; the original is only deleted once the reply went out, so a failed
+    # send never loses the links. Returns the replies sent.
+    lines = [fixed_link.markdown() for fixed_link in fixed_links]
+    if delivery_method == DELIVERY_SUPPRESS:
+        sent, edited = await asyncio.gather(send_replies(message.channel, build_replies(lines)),
+                                            rate_limited_edit(message, suppress=True), return_exceptions=True)
+        for result in (sent, edited):
+            if isinstance(result, Exception):
+                logging.error(f"Failed to deliver fixed links: {result}")
+        return [] if isinstance(sent, Exception) else sent
+
+    author = message.author.mention if mention_users else message.author.display_name
+    try:
+        if delivery_method == DELIVERY_WEBHOOK:
+            # Sent as the bot instead when the channel cannot have a webhook
+            sent = await send_reposts(message, lines, f" | Sent by {author}")
+        else:
+            sent = await send_replies(message.channel, build_replies(lines, f" | Sent by {author}"))
+    except Exception as e:
+        logging.error(f"Failed to deliver fixed links: {e}")
+        return []
+    if sent:
+        try:
+            await rate_limited_delete(message)
+        except Exception as e:
+            logging.error(f"Failed to delete original message: {e}")
+    return sent
+
+# How long a repost waits for the jump URL of a fix that is still being sent
+REPOST_WAIT_TIMEOUT = 10
+
+def claim_links(message, fixed_links):
+    # Splits the links into new ones, claimed for this message until its reply is sent so
+    # that the same link posted at the same time is a repost, and the earlier fixes of the
+    # others: jump URLs, or futures for the ones still being sent
+    new_links = []
+    claims = []
+    previous = []
+    for fixed_link in fixed_links:
+        key = (message.channel.id, fixed_link.service, fixed_link.post_id)
+        entry = recent_links.get(key)
+        if entry is None:
+            claim = asyncio.get_running_loop().create_future()
+            recent_links.add(key, claim)
+            new_links.append(fixed_link)
+            claims.append((key, claim))
+        elif not any(entry is claim for _, claim in claims):
+            previous.append(entry)
+    return new_links, claims, previous
+
+def settle_claims(claims, sent):
+    # Claims become the jump URL of the reply, or are released if nothing was sent
+    jump_url = getattr(sent[0], "jump_url", None) if sent else None
+    for key, claim in claims:
+        if jump_url:
+            recent_links.add(key, jump_url)
+        else:
+            recent_links.release(key, claim)
+        claim.set_result(jump_url)
+
+async def answer_reposts(message, previous, repost_policy):
+    # Answers reposts according to the repost policy. Fixes still being sent are waited
+    # for only after this message's own links went out, so two messages never wait on
+    # each other.
+    jump_url = next((entry for entry in previous if isinstance(entry, str)), None)
+    try:
+        if repost_policy == REPOST_REACT:
+            await rate_limited("react", message.channel.id, lambda: message.add_reaction("🔁"))
+        elif repost_policy == REPOST_REPLY:
+            for entry in previous:
+                if jump_url:
+                    break
+                jump_url = await asyncio.wait_for(asyncio.shield(entry), REPOST_WAIT_TIMEOUT)
+            if jump_url:
+                await rate_limited_send(message.channel, f"Already shared here recently: {jump_url}", reference=message, mention_author=False)
+    except Exception as e:
+        logging.error(f"Failed to answer repost: {e}")
+
+# Fixed links are delivered by a pool of worker tasks fed from a bounded queue, so
+# on_message only parses. Guilds take turns: a worker takes the next job of the guild at
+# the front of the line and sends that guild to the back, and a guild never holds more than
+# a quarter of the workers, so a burst in one busy guild or a rate-limited channel cannot
+# hold up the others. When the queue is full, the oldest job of the guild with the most
+# queued jobs is dropped.
+LINK_WORKERS = int(os.getenv('LINK_WORKERS', 32))
+MAX_QUEUE_DEPTH = int(os.getenv('MAX_QUEUE_DEPTH', 5000))
+GUILD_CONCURRENCY = max(1, LINK_WORKERS // 4)
+
+class LinkJob(NamedTuple):
+    message: discord.Message
+    fixed_links: list
+    settings: GuildSettings
+    queued: float
+    trace: Optional[tracing.Trace]
+
+class LinkQueue:
+
+    def __init__(self, max_depth, guild_concurrency):
+        self.max_depth = max_depth
+        self.guild_concurrency = guild_concurrency
+        self.jobs = {}  # guild_id -> deque of queued jobs, oldest first
+        self.turns = deque()  # Guilds with queued jobs and a free slot, in turn order
+        self.active = Counter()  # guild_id -> jobs in flight
+        self.depth = 0
+        self.shed = 0
+        self.ready = None
+        self.idle = None
+
+    def start(self, workers, handler):
+        self.ready = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        return [asyncio.create_task(self.work(handler)) for _ in range(workers)]
+
+    def put(self, guild_id, job):
+        if self.depth >= self.max_depth:
+            self.shed_oldest()
+        queue = self.jobs.get(guild_id)
+        if queue is None:
+            queue = self.jobs[guild_id] = deque()
+            if self.active[guild_id] < self.guild_concurrency:
+                self.turns.append(guild_id)
+        queue.append(job)
+        self.depth += 1
+        self.ready.set()
+        self.idle.clear()
+
+    def shed_oldest(self):
+        guild_id = max(self.jobs, key=lambda guild_id: len(self.jobs[guild_id]))
+        queue = self.jobs[guild_id]
+        queue.popleft()
+        self.depth -= 1
+        self.shed += 1
+        message_outcomes.inc("shed")
+        if not queue:
+            del self.jobs[guild_id]
+            if guild_id in self.turns:
+                self.turns.remove(guild_id)
+
+    async def get(self):
+        while not self.turns:
+            self.ready.clear()
+            await self.ready.wait()
+        guild_id = self.turns.popleft()
+        queue = self.jobs[guild_id]
+        job = queue.popleft()
+        self.depth -= 1
+        self.active[guild_id] += 1
+        if not queue:
+            del self.jobs[guild_id]
+        elif self.active[guild_id] < self.guild_concurrency:
+            self.turns.append(guild_id)
+        return guild_id, job
+
+    def done(self, guild_id):
+        self.active[guild_id] -= 1
+        # A guild that was at its limit gets back in line
+        if guild_id in self.jobs and self.active[guild_id] == self.guild_concurrency - 1:
+            self.turns.append(guild_id)
+            self.ready.set()
+        if not self.active[guild_id]:
+            del self.active[guild_id]
+            if not self.depth and not self.active:
+                self.idle.set()
+
+    async def work(self, handler):
+        while True:
+            guild_id, job = await self.get()
+            try:
+                await handler(job)
+            except Exception as e:
+                logging.error(f"Error in link worker: {e}")
+            finally:
+                self.done(guild_id)
+
+    async def join(self):
+        # Waits until every queued job has been handled
+        await self.idle.wait()
+
+    async def drain(self, timeout, in_flight_timeout):
+        # Waits for the queued jobs. Past `timeout`, the jobs not started yet are dropped
+        # and the ones being delivered get `in_flight_timeout` more seconds, so a message is
+        # not left with its fixed link sent but the original still there. Returns the
+        # number of jobs dropped.
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+            return 0
+        except asyncio.TimeoutError:
+            pass
+        dropped = self.depth
+        self.jobs.clear()
+        self.turns.clear()
+        self.depth = 0
+        message_outcomes.inc("dropped", amount=dropped)
+        if not self.active:
+            self.idle.set()
+        try:
+            await asyncio.wait_for(self.idle.wait(), in_flight_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"{sum(self.active.values())} link jobs still running at shutdown")
+        return dropped
+
+link_queue = LinkQueue(MAX_QUEUE_DEPTH, GUILD_CONCURRENCY)
+
+async def process_job(job):
+    # Workers are long-lived tasks, so each job brings its message's trace along
+    tracing.current_trace.set(job.trace)
+    now = time.perf_counter()
+    queue_wait_seconds.observe(now - job.queued)
+    if job.trace:
+        job.trace.record("queue_wait", job.queued, now)
+    try:
+        with tracing.span("deliver"):
+            outcome = await deliver_job(job)
+    except Exception as e:
+        logging.error(f"Error delivering fixed links: {e}")
+        outcome = "error"
+    message_outcomes.inc(outcome)
+
+async def deliver_job(job):
+    message, fixed_links, guild_settings = job.message, job.fixed_links, job.settings
+    if share_link_resolver.session is not None:
+        with tracing.span("resolve_share_links"):
+            fixed_links = await resolve_share_links(fixed_links)
+    claims = previous = ()
+    if guild_settings.repost_policy != REPOST_SEND:
+        fixed_links, claims, previous = claim_links(message, fixed_links)
+
+    sent = []
+    try:
+        if fixed_links:
+            for fixed_link in fixed_links:
+                links_fixed.inc(fixed_link.service)
+            sent = await deliver_fixed_links(message, fixed_links, guild_settings.delivery_method, guild_settings.mention_users)
+    finally:
+        settle_claims(claims, sent)
+
+    if previous and guild_settings.repost_policy != REPOST_SKIP:
+        with tracing.span("reposts"):
+            await answer_reposts(message, previous, guild_settings.repost_policy)
+    if not fixed_links:
+        return "repost"
+    return "rewritten" if sent else "error"
 
 def create_footer(embed, client):
     embed.set_footer(text=f"{client.user.name} | v{VERSION}", icon_url=client.user.avatar.url)
 
 async def init_db():
-    db = await aiosqlite.connect('fixembed_data.db')
+    db = await aiosqlite.connect(DATABASE_PATH)
+    await db.execute('PRAGMA journal_mode=WAL')
+    # Other cluster workers may be writing at the same time
+    await db.execute('PRAGMA busy_timeout=5000')
+    await db.execute('PRAGMA synchronous=NORMAL')
     await db.execute('''CREATE TABLE IF NOT EXISTS channel_states (channel_id INTEGER PRIMARY KEY, state BOOLEAN)''')
     await db.commit()
+    await db.execute('''CREATE TABLE IF NOT EXISTS guild_states (guild_id INTEGER PRIMARY KEY, state BOOLEAN)''')
+    await db.commit()
     await db.execute('''CREATE TABLE IF NOT EXISTS guild_settings (guild_id INTEGER PRIMARY KEY, enabled_services TEXT, mention_users BOOLEAN, delete_original BOOLEAN DEFAULT TRUE)''')
     await db.commit()
+    await db.execute('''CREATE TABLE IF NOT EXISTS bot_state (key TEXT PRIMARY KEY, value TEXT)''')
+    await db.commit()
 
     try:
         await db.execute('ALTER TABLE guild_settings ADD COLUMN mention_users BOOLEAN DEFAULT TRUE')
@@ -71,71 +1181,584 @@ async def init_db():
         else:
             raise
 
+    try:
+        await db.execute('ALTER TABLE channel_states ADD COLUMN guild_id INTEGER')
+        await db.commit()
+    except sqlite3.OperationalError as e:
+        if 'duplicate column name' in str(e):
+            pass
+        else:
+            raise
+
+    await db.execute('CREATE INDEX IF NOT EXISTS channel_states_guild_id ON channel_states (guild_id)')
+    await db.commit()
+
+    try:
+        await db.execute('ALTER TABLE guild_settings ADD COLUMN services INTEGER')
+        await db.commit()
+    except sqlite3.OperationalError as e:
+        if 'duplicate column name' in str(e):
+            pass
+        else:
+            raise
+
+    try:
+        await db.execute('ALTER TABLE guild_settings ADD COLUMN repost_policy INTEGER DEFAULT 0')
+        await db.commit()
+    except sqlite3.OperationalError as e:
+        if 'duplicate column name' in str(e):
+            pass
+        else:
+            raise
+
+    try:
+        await db.execute('ALTER TABLE guild_settings ADD COLUMN pinned_mirrors TEXT')
+        await db.commit()
+    except sqlite3.OperationalError as e:
+        if 'duplicate column name' in str(e):
+            pass
+        else:
+            raise
+
+    try:
+        await db.execute('ALTER TABLE guild_settings ADD COLUMN webhook_delivery BOOLEAN DEFAULT FALSE')
+        await db.commit()
+    except sqlite3.OperationalError as e:
+        if 'duplicate column name' in str(e):
+            pass
+        else:
+            raise
+
+    await db.execute('''CREATE TABLE IF NOT EXISTS channel_webhooks (channel_id INTEGER PRIMARY KEY, guild_id INTEGER, webhook_id INTEGER, token TEXT)''')
+    await db.commit()
+    await db.execute('''CREATE TABLE IF NOT EXISTS rewrite_rules (guild_id INTEGER, source_host TEXT, target_host TEXT, PRIMARY KEY (guild_id, source_host))''')
+    await db.commit()
+
+    # Rows from before the services mask stored a repr() of the enabled service names
+    async with db.execute('SELECT guild_id, enabled_services FROM guild_settings WHERE services IS NULL') as cursor:
+        rows = await cursor.fetchall()
+    if rows:
+        await db.executemany('UPDATE guild_settings SET services = ? WHERE guild_id = ?',
+                             [(parse_enabled_services(enabled_services), guild_id) for guild_id, enabled_services in rows])
+        await db.commit()
+
+    # Every change to a guild's settings or channel states is logged by a trigger, so
+    # other processes (cluster workers, admin scripts) can tell which guilds to reload
+    await db.execute('''CREATE TABLE IF NOT EXISTS settings_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, guild_id INTEGER, changed_at INTEGER)''')
+    for table in ('guild_settings', 'guild_states', 'channel_states', 'rewrite_rules'):
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            await db.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_log AFTER {event} ON {table}
+                WHEN {row}.guild_id IS NOT NULL
+                BEGIN INSERT INTO settings_changes (guild_id, changed_at) VALUES ({row}.guild_id, strftime('%s', 'now')); END''')
+    await db.commit()
+
     return db
 
-async def load_channel_states(db):
-    async with db.execute('SELECT channel_id, state FROM channel_states') as cursor:
-        async for row in cursor:
-            channel_states[row[0]] = row[1]
-
-    for guild in client.guilds:
-        for channel in guild.text_channels:
-            if channel.id not in channel_states:
-                channel_states[channel.id] = True
-
-async def load_settings(db):
-    async with db.execute('SELECT guild_id, enabled_services, mention_users, delete_original FROM guild_settings') as cursor:
-        async for row in cursor:
-            guild_id, enabled_services, mention_users, delete_original = row
-            enabled_services_list = eval(enabled_services) if enabled_services else ["Twitter", "Instagram", "Reddit", "Threads", "Pixiv", "Bluesky"]          
-            bot_settings[guild_id] = {
-                "enabled_services": enabled_services_list,
-                "mention_users": mention_users if mention_users is not None else True,
-                "delete_original": delete_original if delete_original is not None else True
-            }
-
-async def update_channel_state(db, channel_id, state):
-    retries = 5
-    for i in range(retries):
-        try:
-            await db.execute('INSERT OR REPLACE INTO channel_states (channel_id, state) VALUES (?, ?)', (channel_id, state))
-            await db.commit()
-            break
-        except sqlite3.OperationalError as e:
-            if 'locked' in str(e):
-                await asyncio.sleep(0.1)
+# Rows from before channel states were grouped by guild get their guild filled in. The
+# channels are only known once their guild is available, so each guild is migrated from
+# on_guild_available.
+legacy_channels = set()
+
+async def load_legacy_channels(db):
+    async with db.execute('SELECT channel_id FROM channel_states WHERE guild_id IS NULL') as cursor:
+        legacy_channels.update(channel_id for channel_id, in await cursor.fetchall())
+
+def migrate_channel_states(guild):
+    channel_ids = [channel.id for channel in itertools.chain(guild.channels, guild.threads) if channel.id in legacy_channels]
+    if not channel_ids:
+        return
+    for channel_id in channel_ids:
+        client.db_writer.write(("legacy_channel", channel_id), "channel_state_guild", (guild.id, channel_id))
+    legacy_channels.difference_update(channel_ids)
+    # The guild may have been loaded without these rows
+    guild_cache.invalidate(guild.id)
+
+def parse_enabled_services(enabled_services):
+    try:
+        names = ast.literal_eval(enabled_services) if enabled_services else SERVICES
+    except (ValueError, SyntaxError):
+        names = SERVICES
+    return sum(SERVICE_BITS[name] for name in set(names) if name in SERVICE_BITS)
+
+def parse_pinned_mirrors(value):
+    # Stored as a JSON object of service name to mirror. Pins to mirrors that are no
+    # longer candidates are dropped.
+    try:
+        pins = json.loads(value) if value else {}
+    except ValueError:
+        return ()
+    return tuple(sorted((service, mirror) for service, mirror in pins.items()
+                        if service in SERVICES and mirror in SERVICES[service]["mirrors"]))
+
+def dump_pinned_mirrors(pinned_mirrors):
+    return json.dumps(dict(pinned_mirrors)) if pinned_mirrors else None
+
+def settings_from_row(row):
+    services, mention_users, delete_original, repost_policy, pinned_mirrors, webhook_delivery = row
+    settings = GuildSettings(
+        services if services is not None else ALL_SERVICES,
+        bool(mention_users) if mention_users is not None else True,
+        bool(delete_original) if delete_original is not None else True,
+        repost_policy if repost_policy in range(len(REPOST_POLICIES)) else REPOST_SEND,
+        parse_pinned_mirrors(pinned_mirrors),
+        bool(webhook_delivery))
+    return DEFAULT_SETTINGS if settings == DEFAULT_SETTINGS else settings
+
+# Number of guilds whose settings and channel states are kept in memory
+GUILD_CACHE_SIZE = int(os.getenv('GUILD_CACHE_SIZE', 10000))
+
+class GuildCache:
+    # Guilds are loaded from the database the first time they are needed and the least
+    # recently used ones are dropped from memory once more than `max_size` are loaded
+
+    def __init__(self, max_size):
+        self.loaded = LRUCache(max_size, on_evict=self.evict)
+        self.loading = Coalescer()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.loaded)
+
+    async def load(self, guild_id):
+        if self.loaded.get(guild_id) is not NOT_CACHED:
+            self.hits += 1
+            return
+        self.misses += 1
+        # Concurrent misses for the same guild share one fetch
+        await self.loading.run(guild_id, lambda: self.fetch(guild_id))
+
+    async def fetch(self, guild_id):
+        # Pending writes may belong to a guild that was just evicted
+        if client.db_writer.pending:
+            await client.db_writer.flush()
+
+        async with client.db.execute('SELECT services, mention_users, delete_original, repost_policy, pinned_mirrors, webhook_delivery FROM guild_settings WHERE guild_id = ?', (guild_id,)) as cursor:
+            settings_row = await cursor.fetchone()
+        async with client.db.execute('SELECT state FROM guild_states WHERE guild_id = ?', (guild_id,)) as cursor:
+            state_row = await cursor.fetchone()
+        async with client.db.execute('SELECT channel_id, state FROM channel_states WHERE guild_id = ?', (guild_id,)) as cursor:
+            channel_rows = await cursor.fetchall()
+        async with client.db.execute('SELECT source_host, target_host FROM rewrite_rules WHERE guild_id = ?', (guild_id,)) as cursor:
+            rule_rows = await cursor.fetchall()
+
+        settings = settings_from_row(settings_row) if settings_row else DEFAULT_SETTINGS
+        if settings is not DEFAULT_SETTINGS:
+            bot_settings[guild_id] = settings
+        guild_state = bool(state_row[0]) if state_row and state_row[0] is not None else True
+        if not guild_state:
+            guild_states[guild_id] = guild_state
+        overrides = {}
+        for channel_id, state in channel_rows:
+            if bool(state) == guild_state:
+                # Only repeats the guild's state
+                update_channel_state(client.db_writer, guild_id, channel_id, None)
             else:
-                raise
+                overrides[channel_id] = bool(state)
+        if overrides:
+            channel_states[guild_id] = overrides
+        if rule_rows:
+            rewrite_rules[guild_id] = RewriteRules(rule_rows)
+            rule_guilds.add(guild_id)
+        else:
+            rule_guilds.discard(guild_id)
+
+        self.loaded.set(guild_id, None)
+
+    def evict(self, guild_id):
+        self.evictions += 1
+        self.forget(guild_id)
+
+    def invalidate(self, guild_id):
+        # Changed by another process: reloaded the next time it is needed
+        task = self.loading.get(guild_id)
+        if task is not None:
+            # The fetch may have read the old rows
+            task.add_done_callback(lambda _: self.invalidate(guild_id))
+        if self.loaded.pop(guild_id):
+            self.invalidations += 1
+            self.forget(guild_id)
+
+    def forget(self, guild_id):
+        bot_settings.pop(guild_id, None)
+        guild_states.pop(guild_id, None)
+        channel_states.pop(guild_id, None)
+        rewrite_rules.pop(guild_id, None)
+
+guild_cache = GuildCache(GUILD_CACHE_SIZE)
+
+# Cross-process cache coherence. `PRAGMA data_version` changes whenever another
+# connection commits, and only then is the change log read for guilds to reload.
+SYNC_INTERVAL = 2  # Seconds between checks
+CHANGE_LOG_RETENTION = 3600  # Seconds a change stays in the log
+
+class ChangeWatcher:
+
+    def __init__(self, db):
+        self.db = db
+        self.data_version = None
+        self.last_seq = 0
+
+    async def start(self):
+        self.data_version = await self.get_data_version()
+        async with self.db.execute('SELECT MAX(seq) FROM settings_changes') as cursor:
+            row = await cursor.fetchone()
+        self.last_seq = row[0] or 0
+
+    async def get_data_version(self):
+        async with self.db.execute('PRAGMA data_version') as cursor:
+            row = await cursor.fetchone()
+        return row[0]
+
+    async def poll(self):
+        data_version = await self.get_data_version()
+        if data_version == self.data_version:
+            return
+        self.data_version = data_version
+        async with self.db.execute('SELECT seq, guild_id FROM settings_changes WHERE seq > ?', (self.last_seq,)) as cursor:
+            changes = await cursor.fetchall()
+        changed = set()
+        for seq, guild_id in changes:
+            self.last_seq = max(self.last_seq, seq)
+            guild_cache.invalidate(guild_id)
+            if on_this_worker(guild_id):
+                changed.add(guild_id)
+        if changed:
+            # Rules this process has not written yet would read as missing
+            if client.db_writer.pending:
+                await client.db_writer.flush()
+            for guild_id in changed:
+                await refresh_rule_guild(self.db, guild_id)
+
+    def prune(self):
+        client.db_writer.write(("prune_changes",), "prune_changes", (int(time.time()) - CHANGE_LOG_RETENTION,))
+
+@tasks.loop(seconds=SYNC_INTERVAL)
+async def watch_changes():
+    try:
+        await client.change_watcher.poll()
+        if watch_changes.current_loop % (CHANGE_LOG_RETENTION // SYNC_INTERVAL) == 0:
+            client.change_watcher.prune()
+    except Exception as e:
+        logging.error(f"Failed to check for settings changes: {e}")
+
+# Write-behind persistence: updates are coalesced per row and a single writer task
+# flushes them in one transaction, every FLUSH_INTERVAL seconds or once FLUSH_SIZE
+# rows are pending
+FLUSH_INTERVAL = 0.5
+FLUSH_SIZE = 500
+
+WRITE_STATEMENTS = {
+    "channel_state": 'INSERT OR REPLACE INTO channel_states (channel_id, guild_id, state) VALUES (?, ?, ?)',
+    "delete_channel_state": 'DELETE FROM channel_states WHERE channel_id = ?',
+    "channel_state_guild": 'UPDATE channel_states SET guild_id = ? WHERE channel_id = ? AND guild_id IS NULL',
+    "delete_guild_channel_states": 'DELETE FROM channel_states WHERE guild_id = ?',
+    "guild_state": 'INSERT OR REPLACE INTO guild_states (guild_id, state) VALUES (?, ?)',
+    "guild_settings": 'INSERT OR REPLACE INTO guild_settings (guild_id, services, mention_users, delete_original, repost_policy, pinned_mirrors, webhook_delivery) VALUES (?, ?, ?, ?, ?, ?, ?)',
+    "prune_changes": 'DELETE FROM settings_changes WHERE changed_at < ?',
+    "bot_state": 'INSERT OR REPLACE INTO bot_state (key, value) VALUES (?, ?)',
+    "channel_webhook": 'INSERT OR REPLACE INTO channel_webhooks (channel_id, guild_id, webhook_id, token) VALUES (?, ?, ?, ?)',
+    "delete_channel_webhook": 'DELETE FROM channel_webhooks WHERE channel_id = ?',
+    "rewrite_rule": 'INSERT OR REPLACE INTO rewrite_rules (guild_id, source_host, target_host) VALUES (?, ?, ?)',
+    "delete_guild_rewrite_rules": 'DELETE FROM rewrite_rules WHERE guild_id = ?',
+}
+
+# Where each statement's parameters hold the guild and channel ID, so flush traces can be
+# tagged with the guilds, shards and channels they wrote
+WRITE_IDS = {
+    "channel_state": (1, 0),
+    "delete_channel_state": (None, 0),
+    "channel_state_guild": (0, 1),
+    "delete_guild_channel_states": (0, None),
+    "guild_state": (0, None),
+    "guild_settings": (0, None),
+    "channel_webhook": (1, 0),
+    "delete_channel_webhook": (None, 0),
+    "rewrite_rule": (0, None),
+    "delete_guild_rewrite_rules": (0, None),
+}
+
+def write_tags(statement, rows):
+    guild_index, channel_index = WRITE_IDS.get(statement, (None, None))
+    tags = {"rows": len(rows)}
+    if guild_index is not None:
+        guild_ids = sorted({row[guild_index] for row in rows})
+        tags["guild"] = ",".join(map(str, guild_ids))
+        tags["shard"] = ",".join(map(str, sorted({(guild_id >> 22) % SHARD_COUNT for guild_id in guild_ids})))
+    if channel_index is not None:
+        tags["channel"] = ",".join(map(str, sorted({row[channel_index] for row in rows})))
+    return tags
+
+class DatabaseWriter:
+
+    def __init__(self, db):
+        self.db = db
+        self.pending = {}
+        self.waiters = []
+        self.wake = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def write(self, key, statement, params):
+        # A newer write to the same key replaces the pending one and moves to the back,
+        # so writes are applied in the order they were last made
+        self.pending.pop(key, None)
+        self.pending[key] = (statement, params)
+        if len(self.pending) >= FLUSH_SIZE:
+            self.wake.set()
+
+    async def flush(self):
+        # Waits until everything written so far is committed
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        self.wake.set()
+        await future
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush_pending()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.flush_pending()
+            except Exception as e:
+                logging.error(f"Failed to flush pending writes: {e}")
+
+    async def flush_pending(self):
+        pending, self.pending = self.pending, {}
+        waiters, self.waiters = self.waiters, []
+        # Consecutive writes using the same statement go into one executemany
+        batches = []
+        for statement, params in pending.values():
+            if batches and batches[-1][0] == statement:
+                batches[-1][1].append(params)
+            else:
+                batches.append((statement, [params]))
 
-async def update_setting(db, guild_id, enabled_services, mention_users, delete_original):
-    retries = 5
-    for i in range(retries):
         try:
-            await db.execute('INSERT OR REPLACE INTO guild_settings (guild_id, enabled_services, mention_users, delete_original) VALUES (?, ?, ?, ?)', (guild_id, repr(enabled_services), mention_users, delete_original))
-            await db.commit()
-            break
-        except sqlite3.OperationalError as e:
-            if 'locked' in str(e):
-                await asyncio.sleep(0.1)
+            await self.commit(batches)
+        except BaseException as e:
+            # Keep the writes for the next flush, ahead of anything written meanwhile
+            newer, self.pending = self.pending, pending
+            for key, write in newer.items():
+                self.pending.pop(key, None)
+                self.pending[key] = write
+            if isinstance(e, Exception):
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
             else:
-                raise
+                self.waiters[:0] = waiters
+            raise
 
-@client.event
-async def on_ready():
-    print(f'We have logged in as {client.user}')
-    logging.info(f'Logged in as {client.user}')
-    client.db = await init_db()
-    await load_channel_states(client.db)
-    await load_settings(client.db)
-    change_status.start()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
 
+    async def commit(self, batches):
+        if not batches:
+            return
+        token = tracing.current_trace.set(tracing.tracer.start(writer="database"))
+        try:
+            await self.commit_batches(batches)
+        finally:
+            tracing.current_trace.reset(token)
+
+    async def commit_batches(self, batches):
+        retries = 5
+        traced = tracing.current_trace.get() is not None
+        for i in range(retries):
+            try:
+                with tracing.span("db.commit", batches=len(batches), attempt=i):
+                    for statement, rows in batches:
+                        with tracing.span(f"db.{statement}", **(write_tags(statement, rows) if traced else {})):
+                            await self.db.executemany(WRITE_STATEMENTS[statement], rows)
+                    await self.db.commit()
+                break
+            except sqlite3.OperationalError as e:
+                await self.db.rollback()
+                if 'locked' in str(e) and i < retries - 1:
+                    await asyncio.sleep(0.1)
+                else:
+                    raise
+
+# Writes only queue here and show up in the caller's trace, if it has one; the database
+# work itself is traced per flush in DatabaseWriter.commit, tagged with the guilds and
+# channels written
+def update_channel_state(db_writer, guild_id, channel_id, state):
+    with tracing.span("db.write", statement="channel_state", guild=str(guild_id), channel=str(channel_id)):
+        if state is None:
+            db_writer.write(("channel", channel_id), "delete_channel_state", (channel_id,))
+        else:
+            db_writer.write(("channel", channel_id), "channel_state", (channel_id, guild_id, state))
+
+def update_guild_state(db_writer, guild_id, state):
+    db_writer.write(("guild_channels", guild_id), "delete_guild_channel_states", (guild_id,))
+    db_writer.write(("guild_state", guild_id), "guild_state", (guild_id, state))
+
+def update_setting(db_writer, guild_id, settings):
+    with tracing.span("db.write", statement="guild_settings", guild=str(guild_id)):
+        db_writer.write(("guild_settings", guild_id), "guild_settings", (guild_id, settings.services, settings.mention_users, settings.delete_original, settings.repost_policy, dump_pinned_mirrors(settings.pinned_mirrors), settings.webhook_delivery))
+
+def update_rewrite_rules(db_writer, guild_id, rules):
+    # The delete moves behind earlier inserts, so only these rules remain
+    db_writer.write(("rewrite_rules", guild_id), "delete_guild_rewrite_rules", (guild_id,))
+    for source, target in rules:
+        db_writer.write(("rewrite_rule", guild_id, source), "rewrite_rule", (guild_id, source, target))
+
+def update_bot_state(db_writer, key, value):
+    db_writer.write(("bot_state", key), "bot_state", (key, value))
+
+async def get_bot_state(db, key):
+    async with db.execute('SELECT value FROM bot_state WHERE key = ?', (key,)) as cursor:
+        row = await cursor.fetchone()
+    return row[0] if row else None
+
+@contextlib.contextmanager
+def startup_phase(name):
+    start = time.perf_counter()
+    yield
+    logging.info(f"Startup: {name} took {(time.perf_counter() - start) * 1000:.0f}ms")
+
+def command_tree_hash():
+    commands = sorted((command.to_dict(client.tree) for command in client.tree.get_commands()), key=lambda command: command["name"])
+    return hashlib.sha256(json.dumps(commands, sort_keys=True).encode()).hexdigest()
+
+async def sync_command_tree():
+    # Syncing is rate-limited, so it only happens when the command definitions changed
+    # since the last successful sync
+    tree_hash = command_tree_hash()
+    if tree_hash == await get_bot_state(client.db, "command_tree_hash"):
+        logging.info("Command tree unchanged, skipping sync")
+        return
     try:
         synced = await client.tree.sync()
         print(f'Synced {len(synced)} command(s)')
+        update_bot_state(client.db_writer, "command_tree_hash", tree_hash)
     except Exception as e:
         print(f'Failed to sync commands: {e}')
 
-    client.launch_time = discord.utils.utcnow()
+@client.event
+async def setup_hook():
+    # Runs once after login and before connecting to the gateway. on_ready fires again
+    # on every reconnect, so nothing that must happen once belongs there.
+    start = time.perf_counter()
+    logging.info(f"Runtime: {runtime_description()}")
+    with startup_phase("database"):
+        client.db = await init_db()
+        client.db_writer = DatabaseWriter(client.db)
+        client.db_writer.start()
+    with startup_phase("channel state migration"):
+        await load_legacy_channels(client.db)
+    limiter_state = await get_bot_state(client.db, LIMITER_STATE_KEY)
+    if limiter_state:
+        rate_limiter.load(json.loads(limiter_state))
+    async with client.db.execute('SELECT DISTINCT guild_id FROM rewrite_rules') as cursor:
+        rule_guilds.update(guild_id for guild_id, in await cursor.fetchall() if on_this_worker(guild_id))
+    with startup_phase("change watcher"):
+        client.change_watcher = ChangeWatcher(client.db)
+        await client.change_watcher.start()
+        watch_changes.start()
+    client.add_dynamic_items(*SETTINGS_ITEMS)
+    client.link_workers = link_queue.start(LINK_WORKERS, process_job)
+    if RESOLVE_SHARE_LINKS:
+        share_link_resolver.start()
+    if MIRROR_PROBE_INTERVAL:
+        mirror_registry.start()
+        probe_mirrors.change_interval(seconds=MIRROR_PROBE_INTERVAL)
+        probe_mirrors.start()
+    change_status.start()
+    if HEALTH_FILE:
+        report_health.start()
+
+    # Commands are global, so only the first cluster syncs them
+    if CLUSTER_ID == 0:
+        with startup_phase("command tree sync"):
+            await sync_command_tree()
+
+    if TRACE_SAMPLE_RATE:
+        tracing.tracer.configure(TRACE_FILE, TRACE_SAMPLE_RATE, TRACE_MAX_BYTES, TRACE_BACKUPS, CLUSTER_ID)
+
+    if METRICS_PORT:
+        with startup_phase("metrics server"):
+            client.metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT + CLUSTER_ID)
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signum, lambda: setattr(client, 'shutdown_task', asyncio.ensure_future(shutdown())))
+        except NotImplementedError:
+            # Not available on Windows, where the process just stops
+            pass
+
+    client.setup_done = time.perf_counter()
+    logging.info(f"Startup: setup took {(client.setup_done - start) * 1000:.0f}ms")
+
+# Graceful shutdown on SIGTERM or SIGINT: new messages are ignored, queued link jobs get
+# DRAIN_TIMEOUT seconds to finish (IN_FLIGHT_TIMEOUT more for the ones already sending),
+# then pending writes and the rate limiter state are saved, so the next start neither
+# loses writes nor runs into 429s right away. Docker stops a container after 10 seconds
+# unless given longer with `docker stop -t`.
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', 5))
+IN_FLIGHT_TIMEOUT = 3
+LIMITER_STATE_KEY = f"rate_limiter_{CLUSTER_ID}"
+
+async def shutdown():
+    if client.draining:
+        return
+    client.draining = True
+    logging.info("Shutting down, draining link jobs")
+    start = time.perf_counter()
+    dropped = await link_queue.drain(DRAIN_TIMEOUT, IN_FLIGHT_TIMEOUT)
+    logging.info(f"Shutdown: drained link jobs in {time.perf_counter() - start:.1f}s ({dropped} dropped)")
+    for worker in client.link_workers:
+        worker.cancel()
+    for loop in (watch_changes, change_status, report_health, probe_mirrors):
+        loop.cancel()
+
+    try:
+        update_bot_state(client.db_writer, LIMITER_STATE_KEY, json.dumps(rate_limiter.dump()))
+        await client.db_writer.close()
+        await client.db.close()
+    except Exception as e:
+        logging.error(f"Failed to save state at shutdown: {e}")
+    await share_link_resolver.close()
+    await mirror_registry.close()
+    if hasattr(client, 'metrics_runner'):
+        await client.metrics_runner.cleanup()
+    logging.info(f"Shutdown: done in {time.perf_counter() - start:.1f}s")
+    await client.close()
+
+@client.event
+async def on_ready():
+    if not hasattr(client, 'launch_time'):
+        print(f'We have logged in as {client.user}')
+        logging.info(f'Logged in as {client.user}')
+        logging.info(f"Startup: gateway ready {time.perf_counter() - client.setup_done:.1f}s after setup")
+        client.launch_time = discord.utils.utcnow()
+    else:
+        logging.info("Reconnected to the gateway")
+
+@client.event
+async def on_guild_available(guild):
+    if legacy_channels:
+        migrate_channel_states(guild)
 
 statuses = itertools.cycle([
     "for Twitter links", "for Reddit links", "for Instagram links", "for Threads links", "for Pixiv links", "for Bluesky links"
@@ -149,6 +1772,37 @@ async def change_status():
     except discord.errors.HTTPException as e:
         logging.error(f"Failed to change status: {e}")
 
+@change_status.before_loop
+async def before_change_status():
+    await client.wait_until_ready()
+
+@tasks.loop(seconds=60)
+async def probe_mirrors():
+    await mirror_registry.probe_all()
+
+@tasks.loop(seconds=HEALTH_INTERVAL)
+async def report_health():
+    health = {
+        "cluster_id": CLUSTER_ID,
+        "pid": os.getpid(),
+        "time": time.time(),
+        "guilds": len(client.guilds),
+        "shards": {shard_id: shard.latency for shard_id, shard in client.shards.items()},
+        "closed": client.is_closed(),
+    }
+    try:
+        # Written next to the target and renamed so the launcher never reads half a file
+        with open(f"{HEALTH_FILE}.tmp", "w") as f:
+            json.dump(health, f)
+        os.replace(f"{HEALTH_FILE}.tmp", HEALTH_FILE)
+    except OSError as e:
+        logging.error(f"Failed to report health: {e}")
+
+@report_health.before_loop
+async def before_report_health():
+    # The launcher gives a worker STARTUP_GRACE seconds to log in before its first report
+    await client.wait_until_ready()
+
 @client.tree.command(
     name='activate',
     description="Activate link processing in this channel or another channel")
@@ -159,8 +1813,8 @@ async def activate(interaction: discord.Interaction,
                    channel: Optional[discord.TextChannel] = None):
     if not channel:
         channel = interaction.channel
-    channel_states[channel.id] = True
-    await update_channel_state(client.db, channel.id, True)
+    await guild_cache.load(channel.guild.id)
+    set_channel_state(channel.guild.id, channel.id, True)
     embed = discord.Embed(title=f"{client.user.name}",
                           description=f'✅ Activated for {channel.mention}!',
                           color=discord.Color(0x78b159))
@@ -177,8 +1831,8 @@ async def deactivate(interaction: discord.Interaction,
                      channel: Optional[discord.TextChannel] = None):
     if not channel:
         channel = interaction.channel
-    channel_states[channel.id] = False
-    await update_channel_state(client.db, channel.id, False)
+    await guild_cache.load(channel.guild.id)
+    set_channel_state(channel.guild.id, channel.id, False)
     embed = discord.Embed(title=f"{client.user.name}",
                           description=f'❌ Deactivated for {channel.mention}!',
                           color=discord.Color.red())
@@ -221,9 +1875,10 @@ async def debug_info(interaction: discord.Interaction, channel: Optional[discord
         channel = interaction.channel
 
     guild = interaction.guild
+    await guild_cache.load(guild.id)
     permissions = channel.permissions_for(guild.me)
-    fix_embed_status = channel_states.get(channel.id, True)
-    fix_embed_activated = all(channel_states.get(ch.id, True) for ch in guild.text_channels)
+    fix_embed_status = is_channel_active(guild.id, channel.id)
+    fix_embed_activated = is_guild_active(guild.id)
 
     embed = discord.Embed(
         title="Debug Information",
@@ -238,12 +1893,13 @@ async def debug_info(interaction: discord.Interaction, channel: Optional[discord
             f"- {'🟢' if permissions.read_messages else '🔴'} Read message permission\n"
             f"- {'🟢' if permissions.send_messages else '🔴'} Send message permission\n"
             f"- {'🟢' if permissions.embed_links else '🔴'} Embed links permission\n"
-            f"- {'🟢' if permissions.manage_messages else '🔴'} Manage messages permission"
+            f"- {'🟢' if permissions.manage_messages else '🔴'} Manage messages permission\n"
+            f"- {'🟢' if permissions.manage_webhooks else '🔴'} Manage webhooks permission"
         ),
         inline=False
     )
 
-    shard_id = client.shard_id if client.shard_id is not None else 0
+    shard_id = guild.shard_id
     embed.add_field(
         name="FixEmbed Stats",
         value=(
@@ -252,456 +1908,572 @@ async def debug_info(interaction: discord.Interaction, channel: Optional[discord
             f"Shard: {shard_id + 1}\n"
             f"Uptime: {str(discord.utils.utcnow() - client.launch_time).split('.')[0]}\n"
             f"Version: {VERSION}\n"
+            f"Messages scanned: {gate_stats['passed']} ({sum(gate_stats.values()) - gate_stats['passed']} skipped)\n"
+            f"Guild cache: {len(guild_cache)} loaded ({guild_cache.hits} hits, {guild_cache.misses} misses, {guild_cache.evictions} evicted)\n"
             f"```"
         ),
         inline=False
     )
 
     create_footer(embed, client)
-    await interaction.response.send_message(embed=embed, view=SettingsView(interaction, bot_settings.get(interaction.guild.id, {"enabled_services": ["Twitter", "Instagram", "Reddit", "Threads", "Pixiv", "Bluesky"], "mention_users": True, "delete_original": True})))
-
-class SettingsDropdown(ui.Select):
-
-    def __init__(self, interaction, settings):
-        self.interaction = interaction
-        self.settings = settings
-        activated = all(
-            channel_states.get(ch.id, True)
-            for ch in interaction.guild.text_channels)
-        mention_users = settings.get("mention_users", True)
-        delete_original = settings.get("delete_original", True)
-        
+    await interaction.response.send_message(embed=embed, view=settings_panel(guild.id), ephemeral=True)
+
+# Settings panels are stateless: each component's custom_id names what it controls, the
+# handlers are registered once with the client, and every callback reads the current
+# settings from the store. Nothing is kept in memory per open panel and nothing times out.
+
+TOGGLE_TITLES = {
+    "fixembed": "FixEmbed Settings",
+    "mention_users": "Mention Users Settings",
+}
+
+def toggle_state(guild_id, setting):
+    if setting == "fixembed":
+        return is_guild_active(guild_id)
+    return getattr(get_guild_settings(guild_id), setting)
+
+def toggle_description(setting, enabled):
+    if setting == "fixembed":
+        return ("**Activate/Deactivate FixEmbed:**\n"
+                f"{'🟢 FixEmbed activated' if enabled else '🔴 FixEmbed deactivated'}\n\n"
+                "**NOTE:** May take a few seconds to apply changes to all channels.")
+    return f"User mentions are currently {'activated' if enabled else 'deactivated'}."
+
+def settings_view(*items):
+    view = ui.View(timeout=None)
+    for item in items:
+        view.add_item(item)
+    return view
+
+def settings_panel(guild_id):
+    return settings_view(SettingsMenu.build(guild_id))
+
+def toggle_panel(guild_id, setting):
+    enabled = toggle_state(guild_id, setting)
+    embed = discord.Embed(
+        title=TOGGLE_TITLES[setting],
+        description=toggle_description(setting, enabled),
+        color=discord.Color.green() if enabled else discord.Color.red())
+    return embed, settings_view(SettingToggle.build(setting, enabled), SettingsMenu.build(guild_id))
+
+def services_panel(guild_id):
+    settings = get_guild_settings(guild_id)
+    service_status_list = "\n".join([
+        f"{'🟢' if settings.service_enabled(service) else '🔴'} {service}"
+        for service in SERVICES
+    ])
+    embed = discord.Embed(
+        title="Service Settings",
+        description=f"Configure which services are activated.\n\n**Activated services:**\n{service_status_list}",
+        color=discord.Color.blurple())
+    return embed, settings_view(ServicesSelect.build(settings), SettingsMenu.build(guild_id))
+
+def repost_panel(guild_id):
+    settings = get_guild_settings(guild_id)
+    embed = discord.Embed(
+        title="Repost Handling Settings",
+        description=f"When a post fixed in the last {REPOST_TTL // 60} minutes is shared again in the same channel: **{REPOST_POLICIES[settings.repost_policy]}**.",
+        color=discord.Color.blurple())
+    return embed, settings_view(RepostSelect.build(settings), SettingsMenu.build(guild_id))
+
+def delivery_panel(guild_id):
+    settings = get_guild_settings(guild_id)
+    embed = discord.Embed(
+        title="Delivery Method Settings",
+        description=f"Fixed links are delivered with: **{DELIVERY_METHODS[settings.delivery_method]}**.\n\n"
+        "Webhook reposts appear under the author's name and avatar and need the Manage Webhooks permission; "
+        "without it the bot reposts the links itself.",
+        color=discord.Color.blurple())
+    return embed, settings_view(DeliverySelect.build(settings), SettingsMenu.build(guild_id))
+
+def rules_panel(guild_id, error=None):
+    rules = rewrite_rules.get(guild_id)
+    lines = [f"`{source}` → `{target}`" for source, target in rules.items()] if rules else ["No rules yet."]
+    description = ("Rewrite links to other hosts, including their subdomains, e.g. `tiktok.com` → `vxtiktok.com`. "
+                   f"Up to {MAX_REWRITE_RULES} rules.\n\n" + "\n".join(lines))
+    if error:
+        description = f"⚠️ {error}\n\n{description}"
+    embed = discord.Embed(title="Rewrite Rules", description=description, color=discord.Color.blurple())
+    items = [RuleAddButton.build()]
+    if rules:
+        items.append(RuleRemoveSelect.build(rules))
+    return embed, settings_view(*items, SettingsMenu.build(guild_id))
+
+def mirror_status(mirror):
+    if mirror_registry.is_down(mirror):
+        return "down"
+    if mirror in mirror_registry.latency:
+        return f"{mirror_registry.latency[mirror] * 1000:.0f}ms"
+    return "not probed"
+
+def mirrors_panel(guild_id, service=None):
+    settings = get_guild_settings(guild_id)
+    pins = dict(settings.pinned_mirrors)
+    lines = []
+    for name in SERVICES:
+        active = mirror_registry.active.get(name)
+        if name in pins:
+            choice = f"📌 {pins[name]} ({mirror_status(pins[name])})"
+        elif active:
+            choice = f"Automatic: {active} ({mirror_status(active)})"
+        else:
+            choice = "Automatic: default hosts"
+        lines.append(f"**{name}**: {choice}")
+    embed = discord.Embed(
+        title="Mirror Settings",
+        description="Fixed links use the fastest healthy mirror of each service unless a mirror is pinned. "
+        "A pinned mirror is skipped while it is down.\n\n" + "\n".join(lines),
+        color=discord.Color.blurple())
+    items = [MirrorServiceSelect.build(service)]
+    if service:
+        items.append(MirrorSelect.build(service, pins.get(service)))
+    return embed, settings_view(*items, SettingsMenu.build(guild_id))
+
+async def can_manage_settings(interaction):
+    # Panels keep working for as long as their message exists, so every callback checks
+    # the member using it
+    if interaction.permissions.manage_guild:
+        return True
+    await interaction.response.send_message("You need the Manage Server permission to change FixEmbed's settings.", ephemeral=True)
+    return False
+
+async def edit_panel(interaction, embed, view):
+    try:
+        await interaction.response.edit_message(embed=embed, view=view)
+    except discord.errors.NotFound:
+        logging.error("Failed to edit original response: Unknown Webhook")
+    except discord.errors.InteractionResponded:
+        try:
+            await interaction.edit_original_response(embed=embed, view=view)
+        except discord.errors.NotFound:
+            logging.error("Failed to edit original response: Unknown Webhook")
+
+class SettingsMenu(ui.DynamicItem[ui.Select], template=r"fixembed:settings"):
+
+    @classmethod
+    def build(cls, guild_id):
+        settings = get_guild_settings(guild_id)
         options = [
             discord.SelectOption(
                 label="FixEmbed",
+                value="fixembed",
                 description="Activate or deactivate the bot in all channels",
-                emoji="🟢" if activated else "🔴"
+                emoji="🟢" if is_guild_active(guild_id) else "🔴"
             ),
             discord.SelectOption(
                 label="Mention Users",
+                value="mention_users",
                 description="Toggle mentioning users in messages",
-                emoji="🔔" if mention_users else "🔕"
+                emoji="🔔" if settings.mention_users else "🔕"
             ),
             discord.SelectOption(
                 label="Delivery Method",
-                description="Toggle original message deletion",
-                emoji="📬" if delete_original else "📪"
+                value="delivery",
+                description="Choose how fixed links are posted",
+                emoji="📬" if settings.delete_original else "📪"
             ),
+            discord.SelectOption(
+                label="Repost Handling",
+                value="repost",
+                description="Choose what happens when a post is shared again",
+                emoji="🔁"),
             discord.SelectOption(
                 label="Service Settings",
+                value="services",
                 description="Configure which services are activated",
                 emoji="⚙️"),
+            discord.SelectOption(
+                label="Rewrite Rules",
+                value="rules",
+                description="Fix links to hosts of your choice",
+                emoji="✏️"),
+            discord.SelectOption(
+                label="Mirrors",
+                value="mirrors",
+                description="Choose which embed mirror each service uses",
+                emoji="🪞"),
             discord.SelectOption(
                 label="Debug",
+                value="debug",
                 description="Show current debug information",
                 emoji="🐞"
             )
         ]
-        super().__init__(placeholder="Choose an option...",
-                         min_values=1,
-                         max_values=1,
-                         options=options)
+        return cls(ui.Select(custom_id="fixembed:settings",
+                             placeholder="Choose an option...",
+                             min_values=1,
+                             max_values=1,
+                             options=options))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(item)
 
     async def callback(self, interaction: discord.Interaction):
-        if self.values[0] == "Delivery Method":
-            delete_original = self.settings.get("delete_original", True)
-            embed = discord.Embed(
-                title="Delivery Method Settings",
-                description=f"Original message deletion is currently {'activated' if delete_original else 'deactivated'}.",
-                color=discord.Color.green() if delete_original else discord.Color.red())
-            view = DeliveryMethodSettingsView(delete_original, self.interaction, self.settings)
-            await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
-        elif self.values[0] == "FixEmbed":
-            activated = all(
-                channel_states.get(ch.id, True)
-                for ch in interaction.guild.text_channels)
-            embed = discord.Embed(
-                title="FixEmbed Settings",
-                description="**Activate/Deactivate FixEmbed:**\n"
-                f"{'🟢 FixEmbed activated' if activated else '🔴 FixEmbed deactivated'}\n\n"
-                "**NOTE:** May take a few seconds to apply changes to all channels.",
-                color=discord.Color.green()
-                if activated else discord.Color.red())
-            view = FixEmbedSettingsView(activated, self.interaction, self.settings)
-            await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
-        elif self.values[0] == "Mention Users":
-            mention_users = self.settings.get("mention_users", True)
-            embed = discord.Embed(
-                title="Mention Users Settings",
-                description=f"User mentions are currently {'activated' if mention_users else 'deactivated'}.",
-                color=discord.Color.green() if mention_users else discord.Color.red())
-            view = MentionUsersSettingsView(mention_users, self.interaction, self.settings)
-            await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
-        elif self.values[0] == "Service Settings":
-            enabled_services = self.settings.get("enabled_services", ["Twitter", "Instagram", "Reddit", "Threads", "Pixiv", "Bluesky"])
-            service_status_list = "\n".join([
-                f"{'🟢' if service in enabled_services else '🔴'} {service}"
-                for service in ["Twitter", "Instagram", "Reddit", "Threads", "Pixiv", "Bluesky"]
-            ])
-            embed = discord.Embed(
-                title="Service Settings",
-                description=f"Configure which services are activated.\n\n**Activated services:**\n{service_status_list}",
-                color=discord.Color.blurple())
-            view = ServiceSettingsView(self.interaction, self.settings)
-            await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
-        elif self.values[0] == "Debug":
+        if not await can_manage_settings(interaction):
+            return
+        guild_id = interaction.guild.id
+        await guild_cache.load(guild_id)
+        choice = self.item.values[0]
+        if choice in TOGGLE_TITLES:
+            embed, view = toggle_panel(guild_id, choice)
+        elif choice == "delivery":
+            embed, view = delivery_panel(guild_id)
+        elif choice == "repost":
+            embed, view = repost_panel(guild_id)
+        elif choice == "services":
+            embed, view = services_panel(guild_id)
+        elif choice == "mirrors":
+            embed, view = mirrors_panel(guild_id)
+        elif choice == "rules":
+            embed, view = rules_panel(guild_id)
+        else:
             await debug_info(interaction, interaction.channel)
+            return
+        await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+
+class SettingToggle(ui.DynamicItem[ui.Button], template=r"fixembed:toggle:(?P<setting>\w+)"):
+
+    def __init__(self, item, setting):
+        super().__init__(item)
+        self.setting = setting
 
+    @classmethod
+    def build(cls, setting, enabled):
+        return cls(ui.Button(custom_id=f"fixembed:toggle:{setting}",
+                             label="Activated" if enabled else "Deactivated",
+                             style=discord.ButtonStyle.green if enabled else discord.ButtonStyle.red),
+                   setting)
 
-class ServicesDropdown(ui.Select):
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        if match["setting"] not in TOGGLE_TITLES:
+            raise ValueError(f"Unknown setting {match['setting']}")
+        return cls(item, match["setting"])
 
-    def __init__(self, interaction, parent_view, settings):
-        self.interaction = interaction
-        self.parent_view = parent_view
-        self.settings = settings
-        enabled_services = settings.get("enabled_services", ["Twitter", "Instagram", "Reddit", "Threads", "Pixiv", "Bluesky"])
+    async def callback(self, interaction: discord.Interaction):
+        if not await can_manage_settings(interaction):
+            return
+        guild_id = interaction.guild.id
+        await guild_cache.load(guild_id)
+        enabled = not toggle_state(guild_id, self.setting)
+        if self.setting == "fixembed":
+            set_guild_state(guild_id, enabled)
+        else:
+            set_guild_settings(guild_id, get_guild_settings(guild_id)._replace(**{self.setting: enabled}))
+        await edit_panel(interaction, *toggle_panel(guild_id, self.setting))
+
+class ServicesSelect(ui.DynamicItem[ui.Select], template=r"fixembed:services"):
+
+    @classmethod
+    def build(cls, settings):
         options = [
             discord.SelectOption(
                 label=service,
                 description=f"Activate or deactivate {service} links",
-                emoji="✅" if service in enabled_services else "❌")
-            for service in ["Twitter", "Instagram", "Reddit", "Threads", "Pixiv", "Bluesky"]
+                emoji="✅" if settings.service_enabled(service) else "❌")
+            for service in SERVICES
         ]
-        super().__init__(placeholder="Select services to activate...",
-                         min_values=1,
-                         max_values=len(options),
-                         options=options)
+        return cls(ui.Select(custom_id="fixembed:services",
+                             placeholder="Select services to activate...",
+                             min_values=1,
+                             max_values=len(options),
+                             options=options))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(item)
 
     async def callback(self, interaction: discord.Interaction):
-        selected_services = self.values
-        guild_id = self.interaction.guild.id
-        self.settings["enabled_services"] = selected_services
-        await update_setting(client.db, guild_id, selected_services, self.settings["mention_users"], self.settings["delete_original"])
-
-        self.parent_view.clear_items()
-        self.parent_view.add_item(
-            ServicesDropdown(self.interaction, self.parent_view, self.settings))
-        self.parent_view.add_item(SettingsDropdown(self.interaction, self.settings))
-
-        service_status_list = "\n".join([
-            f"{'🟢' if service in selected_services else '🔴'} {service}"
-            for service in ["Twitter", "Instagram", "Reddit", "Threads", "Pixiv", "Bluesky"]
-        ])
-        embed = discord.Embed(
-            title="Service Settings",
-            description=f"Configure which services are activated.\n\n**Activated services:**\n{service_status_list}",
-            color=discord.Color.blurple())
-        
-        try:
-            await interaction.response.edit_message(embed=embed, view=self.parent_view)
-        except discord.errors.NotFound:
-            try:
-                await interaction.edit_original_response(embed=embed, view=self.parent_view)
-            except discord.errors.NotFound:
-                logging.error("Failed to edit original response: Unknown Webhook")
-        except discord.errors.InteractionResponded:
-            try:
-                await interaction.edit_original_response(embed=embed, view=self.parent_view)
-            except discord.errors.NotFound:
-                logging.error("Failed to edit original response: Unknown Webhook")
-
-class SettingsView(ui.View):
-
-    def __init__(self, interaction, settings):
-        super().__init__()
-        self.add_item(SettingsDropdown(interaction, settings))
-
-class ServiceSettingsView(ui.View):
-
-    def __init__(self, interaction, settings):
-        super().__init__()
-        self.add_item(ServicesDropdown(interaction, self, settings))
-        self.add_item(SettingsDropdown(interaction, settings))
-
-class FixEmbedSettingsView(ui.View):
-
-    def __init__(self, activated, interaction, settings, timeout=180):
-        super().__init__(timeout=timeout)
-        self.activated = activated
-        self.interaction = interaction
-        self.settings = settings
-        self.toggle_button = discord.ui.Button(
-            label="Activated" if activated else "Deactivated",
-            style=discord.ButtonStyle.green if activated else discord.ButtonStyle.red)
-        self.toggle_button.callback = self.toggle
-        self.add_item(self.toggle_button)
-        self.add_item(SettingsDropdown(interaction, settings))
-
-    async def toggle(self, interaction: discord.Interaction):
-        await interaction.response.defer()
-        
-        self.activated = not self.activated
-        for ch in self.interaction.guild.text_channels:
-            channel_states[ch.id] = self.activated
-            await update_channel_state(client.db, ch.id, self.activated)
-        self.toggle_button.label = "Activated" if self.activated else "Deactivated"
-        self.toggle_button.style = discord.ButtonStyle.green if self.activated else discord.ButtonStyle.red
-
-        embed = discord.Embed(
-            title="FixEmbed Settings",
-            description="**Activate/Deactivate FixEmbed:**\n"
-            f"{'🟢 FixEmbed activated' if self.activated else '🔴 FixEmbed deactivated'}\n\n"
-            "**NOTE:** May take a few seconds to apply changes to all channels.",
-            color=discord.Color.green() if self.activated else discord.Color.red())
+        if not await can_manage_settings(interaction):
+            return
+        guild_id = interaction.guild.id
+        await guild_cache.load(guild_id)
+        services = sum(SERVICE_BITS[service] for service in self.item.values if service in SERVICE_BITS)
+        set_guild_settings(guild_id, get_guild_settings(guild_id)._replace(services=services))
+        await edit_panel(interaction, *services_panel(guild_id))
+
+class DeliverySelect(ui.DynamicItem[ui.Select], template=r"fixembed:delivery"):
+
+    @classmethod
+    def build(cls, settings):
+        descriptions = [
+            "Reply with the fixed links and hide the original embeds",
+            "Delete the original and repost the fixed links",
+            "Delete the original and repost it as the author",
+        ]
+        options = [
+            discord.SelectOption(
+                label=method,
+                value=str(i),
+                description=description,
+                default=i == settings.delivery_method)
+            for i, (method, description) in enumerate(zip(DELIVERY_METHODS, descriptions))
+        ]
+        return cls(ui.Select(custom_id="fixembed:delivery",
+                             placeholder="Choose the delivery method...",
+                             min_values=1,
+                             max_values=1,
+                             options=options))
 
-        try:
-            await interaction.edit_original_response(embed=embed, view=self, ephemeral=True)
-        except discord.errors.NotFound:
-            logging.error("Failed to edit original response: Unknown Webhook")
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(item)
 
-    async def on_timeout(self):
-        for item in self.children:
-            item.disabled = True
+    async def callback(self, interaction: discord.Interaction):
+        if not await can_manage_settings(interaction):
+            return
+        guild_id = interaction.guild.id
+        await guild_cache.load(guild_id)
+        delivery_method = int(self.item.values[0])
+        if delivery_method in range(len(DELIVERY_METHODS)):
+            set_guild_settings(guild_id, get_guild_settings(guild_id)._replace(
+                delete_original=delivery_method != DELIVERY_SUPPRESS,
+                webhook_delivery=delivery_method == DELIVERY_WEBHOOK))
+        await edit_panel(interaction, *delivery_panel(guild_id))
+
+class RepostSelect(ui.DynamicItem[ui.Select], template=r"fixembed:repost"):
+
+    @classmethod
+    def build(cls, settings):
+        descriptions = [
+            "Send the fixed link again",
+            "Ignore the repost",
+            "React to the repost",
+            "Reply with a link to the earlier fixed link",
+        ]
+        options = [
+            discord.SelectOption(
+                label=policy,
+                value=str(i),
+                description=description,
+                default=i == settings.repost_policy)
+            for i, (policy, description) in enumerate(zip(REPOST_POLICIES, descriptions))
+        ]
+        return cls(ui.Select(custom_id="fixembed:repost",
+                             placeholder="Choose what happens to reposts...",
+                             min_values=1,
+                             max_values=1,
+                             options=options))
 
-        embed = discord.Embed(
-            title="FixEmbed Settings",
-            description="This view has timed out and is no longer interactive.",
-            color=discord.Color.red())
-        
-        try:
-            await self.interaction.edit_original_response(embed=embed, view=self, ephemeral=True)
-        except discord.errors.NotFound:
-            logging.error("Failed to edit original response on timeout: Unknown Webhook")
-
-
-class MentionUsersSettingsView(ui.View):
-
-    def __init__(self, mention_users, interaction, settings, timeout=180):
-        super().__init__(timeout=timeout)
-        self.mention_users = mention_users
-        self.interaction = interaction
-        self.settings = settings
-        self.toggle_button = discord.ui.Button(
-            label="Activated" if mention_users else "Deactivated",
-            style=discord.ButtonStyle.green if mention_users else discord.ButtonStyle.red)
-        self.toggle_button.callback = self.toggle
-        self.add_item(self.toggle_button)
-        self.add_item(SettingsDropdown(interaction, settings))
-
-    async def toggle(self, interaction: discord.Interaction):
-        await interaction.response.defer()
-        
-        self.mention_users = not self.mention_users
-        self.settings["mention_users"] = self.mention_users
-        await update_setting(client.db, self.interaction.guild.id, self.settings["enabled_services"], self.mention_users, self.settings["delete_original"])
-        self.toggle_button.label = "Activated" if self.mention_users else "Deactivated"
-        self.toggle_button.style = discord.ButtonStyle.green if self.mention_users else discord.ButtonStyle.red
-
-        embed = discord.Embed(
-            title="Mention Users Settings",
-            description=f"User mentions are currently {'activated' if self.mention_users else 'deactivated'}.",
-            color=discord.Color.green() if self.mention_users else discord.Color.red())
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(item)
 
-        try:
-            await interaction.edit_original_response(embed=embed, view=self)
-        except discord.errors.NotFound:
-            logging.error("Failed to edit original response: Unknown Webhook")
+    async def callback(self, interaction: discord.Interaction):
+        if not await can_manage_settings(interaction):
+            return
+        guild_id = interaction.guild.id
+        await guild_cache.load(guild_id)
+        repost_policy = int(self.item.values[0])
+        if repost_policy in range(len(REPOST_POLICIES)):
+            set_guild_settings(guild_id, get_guild_settings(guild_id)._replace(repost_policy=repost_policy))
+        await edit_panel(interaction, *repost_panel(guild_id))
+
+class MirrorServiceSelect(ui.DynamicItem[ui.Select], template=r"fixembed:mirror_service"):
+
+    @classmethod
+    def build(cls, service):
+        options = [discord.SelectOption(label=name, default=name == service) for name in SERVICES]
+        return cls(ui.Select(custom_id="fixembed:mirror_service",
+                             placeholder="Choose a service...",
+                             min_values=1,
+                             max_values=1,
+                             options=options))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(item)
 
-    async def on_timeout(self):
-        for item in self.children:
-            item.disabled = True
+    async def callback(self, interaction: discord.Interaction):
+        if not await can_manage_settings(interaction):
+            return
+        guild_id = interaction.guild.id
+        await guild_cache.load(guild_id)
+        service = self.item.values[0]
+        await edit_panel(interaction, *mirrors_panel(guild_id, service if service in SERVICES else None))
+
+class MirrorSelect(ui.DynamicItem[ui.Select], template=r"fixembed:mirror:(?P<service>\w+)"):
+
+    def __init__(self, item, service):
+        super().__init__(item)
+        self.service = service
+
+    @classmethod
+    def build(cls, service, pinned):
+        options = [discord.SelectOption(label="Automatic", value="auto", description="Fastest healthy mirror", default=pinned is None)]
+        options += [
+            discord.SelectOption(label=mirror, description=mirror_status(mirror), default=mirror == pinned)
+            for mirror in SERVICES[service]["mirrors"]
+        ]
+        return cls(ui.Select(custom_id=f"fixembed:mirror:{service}",
+                             placeholder=f"Choose the {service} mirror...",
+                             min_values=1,
+                             max_values=1,
+                             options=options),
+                   service)
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        if match["service"] not in SERVICES:
+            raise ValueError(f"Unknown service {match['service']}")
+        return cls(item, match["service"])
 
-        embed = discord.Embed(
-            title="Mention Users Settings",
-            description="This view has timed out and is no longer interactive.",
-            color=discord.Color.red())
-        
-        try:
-            await self.interaction.edit_original_response(embed=embed, view=self)
-        except discord.errors.NotFound:
-            logging.error("Failed to edit original response on timeout: Unknown Webhook")
-
-class DeliveryMethodSettingsView(ui.View):
-
-    def __init__(self, delete_original, interaction, settings, timeout=180):
-        super().__init__(timeout=timeout)
-        self.delete_original = delete_original
-        self.interaction = interaction
-        self.settings = settings
-        self.toggle_button = discord.ui.Button(
-            label="Activated" if delete_original else "Deactivated",
-            style=discord.ButtonStyle.green if delete_original else discord.ButtonStyle.red)
-        self.toggle_button.callback = self.toggle
-        self.add_item(self.toggle_button)
-        self.add_item(SettingsDropdown(interaction, settings))
-
-    async def toggle(self, interaction: discord.Interaction):
-        await interaction.response.defer()
-
-        self.delete_original = not self.delete_original
-        self.settings["delete_original"] = self.delete_original
-        await update_setting(client.db, self.interaction.guild.id, self.settings["enabled_services"], self.settings["mention_users"], self.delete_original)
-        
-        self.toggle_button.label = "Activated" if self.delete_original else "Deactivated"
-        self.toggle_button.style = discord.ButtonStyle.green if self.delete_original else discord.ButtonStyle.red
-
-        embed = discord.Embed(
-            title="Delivery Method Setting",
-            description=f"Original message deletion is now {'activated' if self.delete_original else 'deactivated'}.",
-            color=discord.Color.green() if self.delete_original else discord.Color.red())
+    async def callback(self, interaction: discord.Interaction):
+        if not await can_manage_settings(interaction):
+            return
+        guild_id = interaction.guild.id
+        await guild_cache.load(guild_id)
+        settings = get_guild_settings(guild_id)
+        pins = dict(settings.pinned_mirrors)
+        mirror = self.item.values[0]
+        if mirror in SERVICES[self.service]["mirrors"]:
+            pins[self.service] = mirror
+        else:
+            pins.pop(self.service, None)
+        set_guild_settings(guild_id, settings._replace(pinned_mirrors=tuple(sorted(pins.items()))))
+        await edit_panel(interaction, *mirrors_panel(guild_id, self.service))
+
+class RewriteRuleModal(ui.Modal, title="Add Rewrite Rule"):
+    source = ui.TextInput(label="Host to rewrite", placeholder="tiktok.com", max_length=100)
+    target = ui.TextInput(label="Replacement host", placeholder="vxtiktok.com", max_length=100)
+
+    def __init__(self):
+        super().__init__(timeout=600)
+
+    async def on_submit(self, interaction: discord.Interaction):
+        if not await can_manage_settings(interaction):
+            return
+        guild_id = interaction.guild.id
+        await guild_cache.load(guild_id)
+        rules = rewrite_rules.get(guild_id)
+        rules = dict(rules.items()) if rules else {}
+        source, target = normalize_host(self.source.value), normalize_host(self.target.value)
+        error = check_rewrite_rule(rules, source, target)
+        if not error:
+            rules[source] = target
+            set_rewrite_rules(guild_id, sorted(rules.items()))
+        await edit_panel(interaction, *rules_panel(guild_id, error))
+
+class RuleAddButton(ui.DynamicItem[ui.Button], template=r"fixembed:rules:add"):
+
+    @classmethod
+    def build(cls):
+        return cls(ui.Button(custom_id="fixembed:rules:add", label="Add Rule", style=discord.ButtonStyle.green))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(item)
 
-        try:
-            await interaction.edit_original_response(embed=embed, view=self)
-        except discord.errors.NotFound:
-            logging.error("Failed to edit original response: Unknown Webhook")
+    async def callback(self, interaction: discord.Interaction):
+        if not await can_manage_settings(interaction):
+            return
+        await interaction.response.send_modal(RewriteRuleModal())
 
-    async def on_timeout(self):
-        for item in self.children:
-            item.disabled = True
+class RuleRemoveSelect(ui.DynamicItem[ui.Select], template=r"fixembed:rules:remove"):
 
-        embed = discord.Embed(
-            title="Delivery Method Setting",
-            description="This view has timed out and is no longer interactive.",
-            color=discord.Color.red())
-        
-        try:
-            await self.interaction.edit_original_response(embed=embed, view=self)
-        except discord.errors.NotFound:
-            logging.error("Failed to edit original response on timeout: Unknown Webhook")
+    @classmethod
+    def build(cls, rules):
+        options = [discord.SelectOption(label=source, description=f"→ {target}") for source, target in rules.items()]
+        return cls(ui.Select(custom_id="fixembed:rules:remove",
+                             placeholder="Select rules to remove...",
+                             min_values=1,
+                             max_values=len(options),
+                             options=options))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(item)
+
+    async def callback(self, interaction: discord.Interaction):
+        if not await can_manage_settings(interaction):
+            return
+        guild_id = interaction.guild.id
+        await guild_cache.load(guild_id)
+        rules = rewrite_rules.get(guild_id)
+        if rules:
+            set_rewrite_rules(guild_id, [(source, target) for source, target in rules.items() if source not in self.item.values])
+        await edit_panel(interaction, *rules_panel(guild_id))
+
+SETTINGS_ITEMS = (SettingsMenu, SettingToggle, ServicesSelect, DeliverySelect, RepostSelect, MirrorServiceSelect, MirrorSelect,
+                  RuleAddButton, RuleRemoveSelect)
 
 @client.tree.command(name='settings', description="Configure FixEmbed's settings")
 async def settings(interaction: discord.Interaction):
-    guild_id = interaction.guild.id
-    guild_settings = bot_settings.get(guild_id, {"enabled_services": ["Twitter", "Instagram", "Reddit", "Threads", "Pixiv", "Bluesky"], "mention_users": True, "delete_original": True})
-    
+    if not await can_manage_settings(interaction):
+        return
+    await guild_cache.load(interaction.guild.id)
+
     embed = discord.Embed(title="Settings",
                           description="Configure FixEmbed's settings",
                           color=discord.Color.blurple())
     create_footer(embed, client)
-    await interaction.response.send_message(embed=embed, view=SettingsView(interaction, guild_settings), ephemeral=True)
+    await interaction.response.send_message(embed=embed, view=settings_panel(interaction.guild.id), ephemeral=True)
+
+def start_message_trace(message):
+    if not tracing.tracer.sample_rate:
+        return None
+    guild = message.guild
+    return tracing.tracer.start(
+        message=str(message.id),
+        shard=guild.shard_id if guild else None,
+        guild=str(guild.id) if guild else None,
+        channel=str(message.channel.id))
 
 @client.event
 async def on_message(message):
-    if message.author == client.user:
+    if client.draining:
         return
+    start = time.perf_counter()
+    if passes_gate(message):
+        # Only messages that passed the gate are traced
+        trace = start_message_trace(message)
+        if trace:
+            trace.record("gate", start, time.perf_counter())
+        tracing.current_trace.set(trace)
+        outcome = await handle_message(message, trace)
+        if outcome:
+            message_outcomes.inc(outcome)
+    else:
+        trace = None
+        outcome = "rejected"
+    end = time.perf_counter()
+    message_seconds.observe(end - start)
+    if trace:
+        trace.record("on_message", start, end, {"outcome": outcome or "queued"})
 
-    guild_id = message.guild.id
-    guild_settings = bot_settings.get(guild_id, {
-        "enabled_services": ["Twitter", "Instagram", "Reddit", "Threads", "Pixiv", "Bluesky"],
-        "mention_users": True,
-        "delete_original": True
-    })
-    enabled_services = guild_settings.get("enabled_services", ["Twitter", "Instagram", "Reddit", "Threads", "Pixiv", "Bluesky"])
-    mention_users = guild_settings.get("mention_users", True)
-    delete_original = guild_settings.get("delete_original", True)
-    
-    if channel_states.get(message.channel.id, True):
-        try:
-            # Standard link pattern to capture all the relevant links
-            link_pattern = r"https?://(?:www\.)?(twitter\.com/\w+/status/\d+|x\.com/\w+/status/\d+|instagram\.com/(?:p|reel)/[\w-]+|reddit\.com/r/\w+/s/\w+|reddit\.com/r/\w+/comments/\w+/\w+|old\.reddit\.com/r/\w+/comments/\w+/\w+|pixiv\.net/(?:en/)?artworks/\d+|threads\.net/@[^/]+/post/[\w-]+|bsky\.app/profile/[^/]+/post/[\w-]+)"
-            matches = re.findall(link_pattern, message.content)
-
-            # Regex pattern to detect links surrounded by < >
-            surrounded_link_pattern = r"<https?://(?:www\.)?(twitter\.com/\w+/status/\d+|x\.com/\w+/status/\d+|instagram\.com/(?:p|reel)/[\w-]+|reddit\.com/r/\w+/s/\w+|reddit\.com/r/\w+/comments/\w+/\w+|old\.reddit\.com/r/\w+/comments/\w+/\w+|pixiv\.net/(?:en/)?artworks/\d+|threads\.net/@[^/]+/post/[\w-]+|bsky\.app/profile/[^/]+/post/[\w-]+)>"
-
-            valid_link_found = False
-
-            for original_link in matches:
-                # Skip links if they are surrounded by < >
-                if re.search(surrounded_link_pattern, message.content):
-                    continue  # Skip processing this link
-
-                display_text = ""
-                modified_link = original_link
-                service = ""
-                user_or_community = ""
-
-                # Extract domain from original_link
-                domain = original_link.split('/')[0].lower()  # Get the domain part
-
-                if domain in ['twitter.com', 'x.com']:
-                    service = "Twitter"
-                    user_match = re.findall(
-                        r"(?:twitter\.com|x\.com)/(\w+)/status/\d+",
-                        original_link)
-                    user_or_community = user_match[0] if user_match else "Unknown"
-
-                elif domain == 'instagram.com':
-                    service = "Instagram"
-                    user_match = re.findall(r"instagram\.com/(?:p|reel)/([\w-]+)", original_link)
-                    user_or_community = user_match[0] if user_match else "Unknown"
-
-                elif domain in ['reddit.com', 'old.reddit.com']:
-                    service = "Reddit"
-                    community_match = re.findall(
-                        r"(?:reddit\.com|old\.reddit\.com)/r/(\w+)", original_link)
-                    user_or_community = community_match[0] if community_match else "Unknown"
-                    
-                elif domain == 'pixiv.net':
-                    service = "Pixiv"
-                    user_match = re.findall(r"pixiv\.net/(?:en/)?artworks/(\d+)", original_link)
-                    user_or_community = user_match[0] if user_match else "Unknown"
-
-                elif domain == 'threads.net':
-                    service = "Threads"
-                    user_match = re.findall(r"threads\.net/@([^/]+)/post/([\w-]+)", original_link)
-                    if len(user_match) > 0:
-                        user_or_community, post_id = user_match[0]
-                        modified_link = f"fixthreads.net/@{user_or_community}/post/{post_id}"
-                        display_text = f"Threads • @{user_or_community}"
-
-                elif domain == 'bsky.app':
-                    service = "Bluesky"
-                    bsky_match = re.findall(r"bsky\.app/profile/([^/]+)/post/([\w-]+)", original_link)
-                    if len(bsky_match) > 0:
-                        user_or_community, post_id = bsky_match[0]
-                        modified_link = f"bskyx.app/profile/{user_or_community}/post/{post_id}"
-                        display_text = f"Bluesky • {user_or_community}"
-
-                if service and user_or_community and service in enabled_services:
-                    if not display_text:
-                        display_text = f"{service} • {user_or_community}"
-                    
-                    # Apply service-specific domain replacement
-                    if service == "Twitter":
-                        modified_link = original_link.replace("twitter.com", "fxtwitter.com").replace("x.com", "fixupx.com")
-                    elif service == "Instagram":
-                        modified_link = original_link.replace("instagram.com", "g.ddinstagram.com")
-                    elif service == "Reddit":
-                        if "old.reddit.com" in original_link:
-                            modified_link = original_link.replace("old.reddit.com", "vxreddit.com")
-                        else:
-                            modified_link = original_link.replace("reddit.com", "vxreddit.com")
-                    elif service == "Threads":
-                        modified_link = original_link.replace("threads.net", "fixthreads.net")
-                    elif service == "Pixiv":
-                        modified_link = original_link.replace("pixiv.net", "phixiv.net")
-                    elif service == "Bluesky":
-                        modified_link = original_link.replace("bsky.app", "bskyx.app")
-
-                    valid_link_found = True
-
-                if valid_link_found:
-                    if delete_original:
-                        formatted_message = f"[{display_text}](https://{modified_link})"
-                        if mention_users:
-                            formatted_message += f" | Sent by {message.author.mention}"
-                        else:
-                            formatted_message += f" | Sent by {message.author.display_name}"
-                        await rate_limited_send(message.channel, formatted_message)
-                        await message.delete()
-                    else:
-                        await message.edit(suppress=True)
-                        formatted_message = f"[{display_text}](https://{modified_link})"
-                        await rate_limited_send(message.channel, formatted_message)
+    await client.process_commands(message)
 
-        except Exception as e:
-            logging.error(f"Error in on_message: {e}")
+async def handle_message(message, trace=None):
+    # Returns what happened to a message that passed the gate, or None once its links are
+    # queued for delivery
+    try:
+        with tracing.span("settings"):
+            await guild_cache.load(message.guild.id)
+    except Exception as e:
+        logging.error(f"Failed to load guild settings: {e}")
+        return "error"
+    guild_settings = get_guild_settings(message.guild.id)
 
-    await client.process_commands(message)
+    if not is_channel_active(message.guild.id, message.channel.id):
+        return "disabled"
 
-@client.event
-async def on_guild_join(guild):
-    guild_id = guild.id
-    if guild_id not in bot_settings:
-        bot_settings[guild_id] = {
-            "enabled_services": ["Twitter", "Instagram", "Reddit", "Threads", "Pixiv", "Bluesky"],
-            "mention_users": True,
-            "delete_original": True
-        }
-        await update_setting(client.db, guild_id, bot_settings[guild_id]["enabled_services"], bot_settings[guild_id]["mention_users"], bot_settings[guild_id]["delete_original"])
-
-# Loading the bot token from .env
-load_dotenv()
-bot_token = os.getenv('BOT_TOKEN')
-client.run(bot_token)
+    try:
+        with rewrite_seconds.time(), tracing.span("rewrite"):
+            fixed_links = fix_links(message.content, guild_settings.services, guild_settings.pinned_mirrors,
+                                    rewrite_rules.get(message.guild.id))
+
+        if not fixed_links:
+            return "skipped"
+        link_queue.put(message.guild.id, LinkJob(message, fixed_links, guild_settings, time.perf_counter(), trace))
+        return None
+
+    except Exception as e:
+        logging.error(f"Error in on_message: {e}")
+        return "error"
+
+if __name__ == '__main__':
+    # Loading the bot token from .env
+    bot_token = os.getenv('BOT_TOKEN')
+    install_fast_runtime()
+    client.run(bot_token)
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import sys
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+CANONICAL = "/r/pics/comments/abc123/a_title"
+
+class StandIn:
+    # A local stand-in for Reddit's share link redirects
+
+    def __init__(self):
+        self.requests = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.delay = 0
+
+    async def handle(self, request):
+        name = request.match_info["name"]
+        self.requests[name] = self.requests.get(name, 0) + 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if name == "slow":
+                await asyncio.sleep(5)
+            else:
+                await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        if name.startswith("status"):
+            return web.Response(status=int(name[len("status"):]))
+        if name == "page":
+            return web.Response(text="no redirect")
+        return web.Response(status=301, headers={"Location": f"https://www.reddit.com{CANONICAL}/?share_id=x"})
+
+class ShareLinkResolverTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.stand_in = StandIn()
+        app = web.Application()
+        app.router.add_get("/r/pics/s/{name}", self.stand_in.handle)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.resolver = self.make_resolver()
+
+    async def asyncTearDown(self):
+        await self.resolver.close()
+        await self.server.close()
+
+    def make_resolver(self, concurrency=10, timeout=5):
+        resolver = main.ShareLinkResolver(str(self.server.make_url("")).rstrip("/"), concurrency, timeout, 60, 100)
+        resolver.start()
+        return resolver
+
+    async def test_redirect_resolves_to_canonical(self):
+        self.assertEqual(await self.resolver.resolve("/r/pics/s/abc"), CANONICAL)
+        self.assertEqual(await self.resolver.resolve("/r/pics/s/abc"), CANONICAL)
+        self.assertEqual(self.stand_in.requests["abc"], 1)
+        self.assertEqual((self.resolver.hits, self.resolver.misses), (1, 1))
+
+    async def test_not_found_is_cached_as_unresolvable(self):
+        self.assertIsNone(await self.resolver.resolve("/r/pics/s/status404"))
+        self.assertIsNone(await self.resolver.resolve("/r/pics/s/status404"))
+        self.assertEqual(self.stand_in.requests["status404"], 1)
+        self.assertEqual(self.resolver.failures, 0)
+
+    async def test_page_without_redirect_is_cached_as_unresolvable(self):
+        self.assertIsNone(await self.resolver.resolve("/r/pics/s/page"))
+        self.assertIsNone(self.resolver.cache.get("/r/pics/s/page"))
+
+    async def test_errors_are_not_cached(self):
+        for status in (403, 429, 500, 503):
+            path = f"/r/pics/s/status{status}"
+            self.assertIsNone(await self.resolver.resolve(path))
+            self.assertIsNone(await self.resolver.resolve(path))
+            self.assertEqual(self.stand_in.requests[f"status{status}"], 2)
+            self.assertIs(self.resolver.cache.get(path), main.NOT_CACHED)
+        self.assertEqual(self.resolver.failures, 8)
+
+    async def test_identical_lookups_share_one_request(self):
+        self.stand_in.delay = 0.1
+        results = await asyncio.gather(*(self.resolver.resolve("/r/pics/s/abc") for _ in range(5)))
+        self.assertEqual(results, [CANONICAL] * 5)
+        self.assertEqual(self.stand_in.requests["abc"], 1)
+
+    async def test_lookups_in_flight_are_capped(self):
+        await self.resolver.close()
+        self.resolver = self.make_resolver(concurrency=2)
+        self.stand_in.delay = 0.05
+        results = await asyncio.gather(*(self.resolver.resolve(f"/r/pics/s/link{i}") for i in range(6)))
+        self.assertEqual(results, [CANONICAL] * 6)
+        self.assertEqual(self.stand_in.max_in_flight, 2)
+
+    async def test_timeout_is_a_failure_and_not_cached(self):
+        await self.resolver.close()
+        self.resolver = self.make_resolver(timeout=0.2)
+        self.assertIsNone(await self.resolver.resolve("/r/pics/s/slow"))
+        self.assertEqual(self.resolver.failures, 1)
+        self.assertIs(self.resolver.cache.get("/r/pics/s/slow"), main.NOT_CACHED)
+
+if __name__ == "__main__":
+    unittest.main()
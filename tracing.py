@@ -0,0 +1,115 @@
+import contextvars
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import random
+import sys
+import time
+
+# Sampled tracing. A trace follows one message (or one database flush) through the bot,
+# and every span in it is written as a Chrome trace event, one JSON object per line, to a
+# rotating file. `python tracing.py traces/*.jsonl > trace.json` turns files into a trace
+# that chrome://tracing or ui.perfetto.dev can open.
+
+# Spans are timed with perf_counter and placed on the wall clock for the viewer
+WALL_OFFSET = time.time() - time.perf_counter()
+
+# The trace of the task being run, if it is sampled
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class Tracer:
+
+    def __init__(self):
+        self.sample_rate = 0
+        self.pid = 0
+        # Each trace gets its own lane (thread id) in the viewer
+        self.ids = itertools.count(1)
+        self.logger = logging.getLogger("fixembed.trace")
+        self.logger.propagate = False
+
+    def configure(self, path, sample_rate, max_bytes, backups, pid):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, delay=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self.logger.addHandler(handler)
+        self.logger.setLevel(logging.INFO)
+        self.sample_rate = sample_rate
+        self.pid = pid
+
+    def start(self, **tags):
+        # Returns a new trace, or None if this one is not sampled
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        return Trace(self, next(self.ids), tags)
+
+class Trace:
+
+    def __init__(self, tracer, trace_id, tags):
+        self.tracer = tracer
+        self.id = trace_id
+        self.tags = tags
+
+    def record(self, name, start, end, tags=None):
+        event = {
+            "name": name,
+            "cat": "fixembed",
+            "ph": "X",
+            "ts": round((start + WALL_OFFSET) * 1000000),
+            "dur": round((end - start) * 1000000),
+            "pid": self.tracer.pid,
+            "tid": self.id,
+            "args": dict(self.tags, **tags) if tags else self.tags,
+        }
+        self.tracer.logger.info(json.dumps(event))
+
+class Span:
+    __slots__ = ("trace", "name", "tags", "start")
+
+    def __init__(self, trace, name, tags):
+        self.trace = trace
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.record(self.name, self.start, time.perf_counter(), self.tags)
+
+class NullSpan:
+    # Stands in for a span when the current task is not traced
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_SPAN = NullSpan()
+
+tracer = Tracer()
+
+def span(name, **tags):
+    trace = current_trace.get()
+    if trace is None:
+        return NULL_SPAN
+    return Span(trace, name, tags)
+
+def to_chrome(paths, out):
+    # Wraps the events of trace files (e.g. every cluster's) in the JSON object format
+    # trace viewers load
+    out.write('{"traceEvents": [\n')
+    first = True
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    out.write(("" if first else ",\n") + line.strip())
+                    first = False
+    out.write('\n]}\n')
+
+if __name__ == "__main__":
+    to_chrome(sys.argv[1:], sys.stdout)